@@ -1,15 +1,36 @@
+import hashlib
 import http.client
 import json
 import logging
-from datetime import datetime, timedelta
-from config import AHREFS_API_KEY, AHREFS_API_URL
-
-# Глобальный флаг для отслеживания лимитов API
-_api_limit_reached = False
+import os
+import random
+import tempfile
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, quote, urlparse
+from ahrefs_cache import AhrefsResponseCache
+from ahrefs_targets import TargetBatch, batch_targets, normalize_target
+from run_deadline import DeadlineExceeded, fetch_time_left
+from config import (
+    AHREFS_API_KEYS, AHREFS_KEY_MAX_CONCURRENCY, AHREFS_MIN_UNITS_PER_REQUEST,
+    AHREFS_API_URL, AHREFS_POOL_SIZE, AHREFS_POOL_IDLE_TIMEOUT, AHREFS_MAX_RESPONSE_BYTES,
+    AHREFS_FALLBACK_WORKERS, AHREFS_RATE_LIMIT_RPM, AHREFS_RATE_LIMIT_BURST,
+    AHREFS_MAX_CONCURRENCY, AHREFS_MAX_THROTTLE_RETRIES, AHREFS_MAX_RETRY_AFTER,
+    AHREFS_MAX_RETRIES, AHREFS_RETRY_BASE_DELAY, AHREFS_RETRY_MAX_DELAY,
+    AHREFS_LIMIT_STATE_FILE, AHREFS_LOG_LEVEL, AHREFS_LOG_STRUCTURED, AHREFS_LOG_BODY_SAMPLE_RATE,
+    AHREFS_LOG_BODY_MAX_CHARS, AHREFS_EXTRA_METRICS, AHREFS_HEALTH_TTL,
+    AHREFS_CONNECT_TIMEOUT, AHREFS_READ_TIMEOUT,
+    AHREFS_BATCH_SIZE, AHREFS_MIN_BATCH_SIZE, AHREFS_MAX_BATCH_SIZE, AHREFS_BATCH_TARGET_LATENCY
+)
 
 # Настройка логирования
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=getattr(logging, AHREFS_LOG_LEVEL, logging.INFO),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.FileHandler("ahrefs_api.log"),
@@ -18,55 +39,930 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Начальное и максимальное количество целей в одном batch-analysis запросе
+# (текущий размер подбирает AdaptiveBatchSizer)
+BATCH_SIZE = min(AHREFS_BATCH_SIZE, AHREFS_MAX_BATCH_SIZE)
+MAX_BATCH_SIZE = AHREFS_MAX_BATCH_SIZE
+
+# Endpoint'ы API Ahrefs
+METRICS_ENDPOINT = "/v3/site-explorer/metrics"
+BATCH_ENDPOINT = "/v3/site-explorer/batch-analysis"
+HISTORY_ENDPOINT = "/v3/site-explorer/metrics-history"
+
+# Поля, которые читает конвейер: только они запрашиваются у API (параметр select Ahrefs v3).
+# index и url нужны, чтобы сопоставить строки ответа batch-analysis с целями запроса
+SELECT_FIELDS = list(dict.fromkeys(["org_traffic"] + AHREFS_EXTRA_METRICS))
+BATCH_SELECT_FIELDS = ["index", "url"] + SELECT_FIELDS
+
+# Ответ API Ahrefs, полностью прочитанный из соединения
+# elapsed - время последней попытки запроса в секундах (без ожидания в ограничителе и пауз между повторами)
+AhrefsResponse = namedtuple('AhrefsResponse', ['status', 'headers', 'text', 'elapsed'], defaults=(None,))
+
+# Ошибки, после которых переиспользованное соединение считается разорванным сервером
+_RECONNECT_ERRORS = (ConnectionError, http.client.BadStatusLine, http.client.ImproperConnectionState)
+
+# Временные ошибки, после которых запрос повторяется с экспоненциальной задержкой
+_TRANSIENT_STATUSES = (408, 500, 502, 503, 504)
+_TRANSIENT_ERRORS = (OSError, http.client.HTTPException)
+
+# Размер блока при потоковом чтении и распаковке ответа
+_READ_CHUNK_SIZE = 64 * 1024
+
+class ResponseTooLargeError(Exception):
+    """Ответ API больше AHREFS_MAX_RESPONSE_BYTES (после распаковки)"""
+
+class TrafficResult(namedtuple('TrafficResult', ['status', 'value', 'metrics'], defaults=(None,))):
+    """
+    Результат получения трафика домена.
+
+    status принимает одно из значений:
+        OK - value содержит значение трафика
+        MISSING - значение получить не удалось (ошибка API, сети или разбора ответа)
+        LIMIT_REACHED - запрос не выполнен, потому что достигнут лимит API
+
+    metrics - словарь {поле: значение} дополнительных метрик (AHREFS_EXTRA_METRICS),
+    полученных тем же запросом, или None. Метрик, которых не было в ответе, в словаре нет.
+    """
+    __slots__ = ()
+
+    OK = 'ok'
+    MISSING = 'missing'
+    LIMIT_REACHED = 'limit_reached'
+
+    @classmethod
+    def ok(cls, value, metrics=None):
+        return cls(cls.OK, int(value), metrics)
+
+    @classmethod
+    def missing(cls):
+        return cls(cls.MISSING, None)
+
+    @classmethod
+    def limit_reached(cls):
+        return cls(cls.LIMIT_REACHED, None)
+
+    @property
+    def is_ok(self):
+        return self.status == self.OK
+
+class AhrefsConnectionPool:
+    """
+    Потокобезопасный пул постоянных HTTPS-соединений к API Ahrefs.
+
+    Соединения переиспользуются между запросами (keep-alive), поэтому TCP + TLS
+    handshake выполняется один раз на соединение, а не на каждый запрос.
+    Ответы в gzip/deflate распаковываются потоково; если ответ больше
+    max_response_bytes, чтение прерывается, а соединение закрывается.
+    Соединения, простоявшие дольше idle_timeout, закрываются. Если сервер
+    разорвал переиспользованное соединение, запрос повторяется один раз
+    через новое соединение.
+
+    Args:
+        host (str): Хост API (с портом, если он нестандартный)
+        max_size (int): Максимум простаивающих соединений в пуле
+        idle_timeout (float): Время простоя в секундах, после которого соединение закрывается
+        scheme (str): "https" или "http" (для локального ahrefs_stub_server)
+        max_response_bytes (int): Максимальный размер ответа после распаковки
+        connect_timeout (float): Таймаут установки соединения в секундах
+        read_timeout (float): Таймаут ожидания данных в секундах (по умолчанию для request)
+    """
+
+    def __init__(self, host, max_size=AHREFS_POOL_SIZE, idle_timeout=AHREFS_POOL_IDLE_TIMEOUT, scheme="https",
+                 max_response_bytes=AHREFS_MAX_RESPONSE_BYTES, connect_timeout=AHREFS_CONNECT_TIMEOUT,
+                 read_timeout=AHREFS_READ_TIMEOUT):
+        self.host = host
+        self.scheme = scheme
+        self.max_response_bytes = max_response_bytes
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle = []  # Пары (соединение, время возврата в пул)
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.scheme == "http":
+            return http.client.HTTPConnection(self.host, timeout=self.connect_timeout)
+        return http.client.HTTPSConnection(self.host, timeout=self.connect_timeout)
+
+    def _acquire(self):
+        """Возвращает (соединение, переиспользовано ли оно)"""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if now - released_at < self.idle_timeout:
+                    return conn, True
+                # Соединение простаивало слишком долго - сервер мог его уже закрыть
+                conn.close()
+        return self._new_connection(), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _read_body(self, response):
+        """
+        Читает тело ответа блоками, распаковывая gzip/deflate на лету.
+
+        Raises:
+            ResponseTooLargeError: Если ответ больше max_response_bytes
+        """
+        encoding = (response.getheader('Content-Encoding') or 'identity').strip().lower()
+        if encoding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+            raise http.client.HTTPException(f"Непідтримуване кодування відповіді: {encoding}")
+
+        decoder = None
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            if encoding == 'identity':
+                data = chunk
+            else:
+                if decoder is None:
+                    if encoding == 'deflate' and (len(chunk) < 2 or (chunk[0] & 0x0f != 8)
+                                                  or (chunk[0] << 8 | chunk[1]) % 31):
+                        # Некоторые серверы отдают deflate без zlib-заголовка
+                        decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                    else:
+                        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding != 'deflate' else zlib.MAX_WBITS)
+                # Распаковываем не больше, чем осталось до лимита, чтобы "zip-бомба" не заняла память
+                data = decoder.decompress(chunk, self.max_response_bytes - size + 1)
+                while decoder.unconsumed_tail and size + len(data) <= self.max_response_bytes:
+                    chunks.append(data)
+                    size += len(data)
+                    data = decoder.decompress(decoder.unconsumed_tail, self.max_response_bytes - size + 1)
+            size += len(data)
+            if size > self.max_response_bytes:
+                raise ResponseTooLargeError(f"Відповідь більша за {self.max_response_bytes} байт")
+            chunks.append(data)
+
+        if decoder is not None:
+            data = decoder.flush()
+            size += len(data)
+            if size > self.max_response_bytes:
+                raise ResponseTooLargeError(f"Відповідь більша за {self.max_response_bytes} байт")
+            chunks.append(data)
+        return b"".join(chunks)
+
+    def request(self, method, endpoint, body=None, headers=None, timeout=None):
+        """
+        Выполняет запрос через соединение из пула и полностью читает ответ.
+
+        Args:
+            timeout (float): Таймаут ожидания данных (по умолчанию read_timeout). Установка
+                             соединения ограничена connect_timeout, но не дольше timeout
+
+        Returns:
+            AhrefsResponse: Статус, заголовки и текст ответа
+        """
+        read_timeout = timeout or self.read_timeout
+        started = time.monotonic()
+        while True:
+            conn, reused = self._acquire()
+            try:
+                if conn.sock is None:
+                    conn.timeout = min(self.connect_timeout, read_timeout)
+                    conn.connect()
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, endpoint, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = self._read_body(response)
+            except _RECONNECT_ERRORS as e:
+                conn.close()
+                if reused:
+                    logger.info(f"З'єднання з {self.host} розірване сервером ({type(e).__name__}), перепідключаємось")
+                    continue
+                raise
+            except Exception:
+                # Недочитанный ответ (в том числе слишком большой) - соединение дальше не используем
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return AhrefsResponse(response.status, response.headers, data.decode("utf-8"),
+                                  time.monotonic() - started)
+
+    def close(self):
+        """Закрывает все простаивающие соединения"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+class AdaptiveRateLimiter:
+    """
+    Адаптивный ограничитель запросов к API Ahrefs.
+
+    Темп запросов ограничивается token bucket'ом, а количество одновременных
+    запросов - лимитом, который подстраивается по схеме AIMD: после каждого
+    успешного ответа лимит растет на 1/limit (то есть на единицу за "окно"
+    успешных запросов), а после 429 уменьшается вдвое. Заголовок Retry-After
+    приостанавливает выдачу новых разрешений до указанного момента, но не дольше
+    max_pause: запрос с большим Retry-After не повторяется, и ждать его
+    остальным потокам незачем.
+
+    Args:
+        rate (float): Количество запросов в секунду
+        burst (int): Размер корзины токенов
+        max_concurrency (int): Верхняя граница одновременных запросов
+        max_pause (float): Максимальная пауза после 429 в секундах
+    """
+
+    def __init__(self, rate, burst, max_concurrency, max_pause=AHREFS_MAX_RETRY_AFTER):
+        self.rate = rate
+        self.max_pause = max_pause
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._blocked_until = 0.0
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def acquire(self):
+        """
+        Блокирует поток, пока запрос нельзя отправить, но не дольше времени,
+        оставшегося на сбор данных до дедлайна запуска.
+
+        Raises:
+            DeadlineExceeded: Если время на сбор данных истекло во время ожидания
+        """
+        with self._condition:
+            while True:
+                time_left = fetch_time_left()
+                if time_left is not None and time_left <= 0:
+                    raise DeadlineExceeded("Час на збір даних Ahrefs вичерпано")
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    timeout = self._blocked_until - now
+                elif self._in_flight >= int(self.concurrency_limit):
+                    # Ждем, пока освободится место (release вызовет notify)
+                    timeout = None
+                elif self._tokens < 1:
+                    timeout = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                if time_left is not None:
+                    timeout = time_left if timeout is None else min(timeout, time_left)
+                self._condition.wait(timeout)
+
+    def release(self, throttled=False, retry_after=None):
+        """
+        Возвращает разрешение после завершения запроса.
+
+        Args:
+            throttled (bool): Получен ли ответ 429
+            retry_after (float): Значение Retry-After в секундах, если оно было в ответе
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+                # Без Retry-After делаем паузу длиной в интервал между двумя токенами
+                pause = min(retry_after if retry_after is not None else 1 / self.rate, self.max_pause)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+                self._tokens = 0.0
+                logger.warning(f"Отримано 429: паралельність знижено до {int(self.concurrency_limit)}, "
+                               f"пауза {pause:.1f} с")
+            else:
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+            self._condition.notify_all()
+
+class AdaptiveBatchSizer:
+    """
+    Подбирает размер batch-analysis запросов по наблюдаемой задержке, ошибкам и размеру ответов.
+
+    После таймаута или 5xx, как и после слишком большого ответа, текущий размер
+    уменьшается вдвое; слишком медленный ответ уменьшает его пропорционально
+    задержке. Batch'и меньше половины текущего размера (хвосты режимов, повторы
+    половин неудачного batch'а) на размер не влияют. Каждый успешный полный
+    batch увеличивает размер на четверть, но не выше max_size (ограничение Ahrefs).
+
+    Args:
+        initial (int): Начальный размер
+        min_size (int): Минимальный размер
+        max_size (int): Максимальный размер
+        target_latency (float): Желаемое время одного запроса в секундах
+        max_response_bytes (int): Размер ответа, к которому нельзя приближаться больше чем наполовину
+    """
+
+    def __init__(self, initial=BATCH_SIZE, min_size=AHREFS_MIN_BATCH_SIZE, max_size=MAX_BATCH_SIZE,
+                 target_latency=AHREFS_BATCH_TARGET_LATENCY, max_response_bytes=AHREFS_MAX_RESPONSE_BYTES):
+        self.max_size = max(1, max_size)
+        self.min_size = max(1, min(min_size, self.max_size))
+        self.size = max(self.min_size, min(initial, self.max_size))
+        self.target_latency = target_latency
+        self.max_response_bytes = max_response_bytes
+        self._lock = threading.Lock()
+
+    def record(self, batch_len, latency=None, failed=False, response_bytes=None):
+        """
+        Учитывает результат batch запроса.
+
+        Args:
+            batch_len (int): Количество целей в batch'е
+            latency (float): Время ответа API в секундах
+            failed (bool): Запрос завершился таймаутом или 5xx
+            response_bytes (int): Размер ответа после распаковки
+        """
+        with self._lock:
+            old_size = self.size
+            if batch_len < self.size // 2:
+                # Неполный batch (хвост режима, повтор половины) ничего не говорит о текущем размере
+                pass
+            elif failed:
+                self.size = max(self.min_size, self.size // 2)
+            elif response_bytes and response_bytes > self.max_response_bytes / 2:
+                self.size = max(self.min_size, self.size // 2)
+            elif latency and latency > self.target_latency:
+                self.size = max(self.min_size, min(self.size, int(batch_len * self.target_latency / latency)))
+            elif batch_len >= self.size:
+                # Рост только после полного batch'а: неполный последний batch ничего не говорит о большем размере
+                self.size = min(self.max_size, self.size + max(1, self.size // 4))
+            if self.size != old_size:
+                logger.info(f"Розмір batch змінено: {old_size} -> {self.size} "
+                            f"({'помилка' if failed else f'{latency or 0:.1f} с, {response_bytes or 0} B'})")
+
+class SingleFlight:
+    """
+    Объединяет одновременные одинаковые вызовы: пока вызов с ключом key
+    выполняется, остальные вызывающие с тем же ключом ждут его и получают
+    тот же результат (или то же исключение), не выполняя вызов повторно.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> Future выполняющегося вызова
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        Выполняет fn() или присоединяется к уже выполняющемуся вызову с тем же ключом.
+
+        Returns:
+            Результат fn()
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            logger.debug(f"Об'єднуємо однаковий запит з уже відправленим: {key[0]} {key[1].split('?')[0]}")
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+class AhrefsApiKey:
+    """
+    Ключ API и его состояние: запросы в работе, остаток units и достигнутый лимит.
+
+    Сам ключ никогда не пишется в лог и в файл состояния - только его отпечаток.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.fingerprint = hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+        self.in_flight = 0
+        self.budget = None  # Остаток units по subscription-info (None - неизвестен)
+        self.tripped_at = None
+        self.next_reset = None  # Дата обновления лимитов, если лимит ключа достигнут
+
+    @property
+    def tripped(self):
+        return self.next_reset is not None
+
+class AhrefsKeyPool:
+    """
+    Пул ключей API Ahrefs.
+
+    Запрос получает ключ с наибольшим запасом: сначала ключи с остатком units
+    (или с неизвестным остатком), затем наименее загруженные. Каждому ключу
+    разрешено не больше max_concurrency одновременных запросов. Ответ 403 об
+    исчерпанном лимите units отключает только ключ, получивший его, до 24 числа; состояние ключей
+    хранится в AHREFS_LIMIT_STATE_FILE по отпечатку ключа.
+
+    Args:
+        keys (list): Ключи API
+        max_concurrency (int): Максимум одновременных запросов на один ключ
+    """
+
+    def __init__(self, keys, max_concurrency=AHREFS_KEY_MAX_CONCURRENCY):
+        self.keys = [AhrefsApiKey(key) for key in dict.fromkeys(keys)]
+        self.max_concurrency = max(1, max_concurrency)
+        self._cond = threading.Condition()
+
+    @property
+    def all_tripped(self):
+        return bool(self.keys) and all(key.tripped for key in self.keys)
+
+    def next_reset(self):
+        """Ближайшая дата обновления лимитов среди отключенных ключей или None"""
+        resets = [key.next_reset for key in self.keys if key.tripped]
+        return min(resets) if resets else None
+
+    def acquire(self, pinned=None):
+        """
+        Выбирает ключ для запроса, дожидаясь свободного места, если все ключи заняты.
+
+        Args:
+            pinned (AhrefsApiKey): Использовать только этот ключ (даже если его лимит достигнут)
+
+        Returns:
+            AhrefsApiKey: Ключ или None, если лимит достигнут на всех ключах
+        """
+        with self._cond:
+            while True:
+                candidates = [pinned] if pinned is not None else [key for key in self.keys if not key.tripped]
+                if not candidates:
+                    return None
+                free = [key for key in candidates if key.in_flight < self.max_concurrency]
+                if free:
+                    key = max(free, key=lambda k: (k.budget is None or k.budget >= AHREFS_MIN_UNITS_PER_REQUEST,
+                                                   -k.in_flight,
+                                                   k.budget if k.budget is not None else float('inf')))
+                    key.in_flight += 1
+                    return key
+                self._cond.wait()
+
+    def release(self, key, units=None):
+        """Возвращает ключ после запроса и списывает потраченные units с его остатка"""
+        with self._cond:
+            key.in_flight -= 1
+            if units and key.budget is not None:
+                key.budget = max(0, key.budget - units)
+            self._cond.notify_all()
+
+    def set_budget(self, key, units):
+        """Устанавливает остаток units ключа по данным subscription-info"""
+        with self._cond:
+            key.budget = units
+            self._cond.notify_all()
+
+    def total_budget(self):
+        """Сумма остатков units по ключам с известным остатком (None, если остаток неизвестен для всех)"""
+        with self._cond:
+            budgets = [key.budget for key in self.keys if key.budget is not None and not key.tripped]
+            known = any(key.budget is not None for key in self.keys)
+        return sum(budgets) if known else None
+
+    def trip(self, key):
+        """
+        Отключает ключ, исчерпавший лимит units (403), до обновления лимитов.
+
+        Returns:
+            bool: True, если остались ключи с неисчерпанным лимитом
+        """
+        with self._cond:
+            if not key.tripped:
+                key.tripped_at = datetime.now()
+                key.next_reset = _next_limit_reset(key.tripped_at)
+                logger.warning(f"🚫 Ліміт API досягнуто для ключа {key.fingerprint}, ключ вимкнено до "
+                               f"{key.next_reset.strftime('%d.%m.%Y')}")
+                self._persist()
+            self._cond.notify_all()
+            return any(not k.tripped for k in self.keys)
+
+    def load_state(self):
+        """Восстанавливает отключенные ключи из AHREFS_LIMIT_STATE_FILE"""
+        entries = _load_limit_state()
+        legacy = entries.get("*")
+        with self._cond:
+            for key in self.keys:
+                entry = entries.get(key.fingerprint) or legacy
+                if entry is not None:
+                    key.tripped_at, key.next_reset = entry
+                    logger.warning(f"Ліміт API для ключа {key.fingerprint} досягнуто {key.tripped_at}, "
+                                   f"оновлення лімітів {key.next_reset.strftime('%d.%m.%Y')}")
+
+    def reset_expired(self, today):
+        """
+        Включает ключи, лимиты которых уже обновились.
+
+        Returns:
+            bool: True, если хотя бы один ключ был включен
+        """
+        with self._cond:
+            expired = [key for key in self.keys if key.tripped and today >= key.next_reset]
+            for key in expired:
+                key.tripped_at = key.next_reset = None
+            if expired:
+                self._persist()
+                self._cond.notify_all()
+            return bool(expired)
+
+    def reset_all(self):
+        with self._cond:
+            for key in self.keys:
+                key.tripped_at = key.next_reset = None
+            self._cond.notify_all()
+
+    def _persist(self):
+        # Записи ключей, которых сейчас нет в пуле, сохраняются до их обновления
+        entries = {fingerprint: entry for fingerprint, entry in _load_limit_state().items() if fingerprint != "*"}
+        for key in self.keys:
+            if key.tripped:
+                entries[key.fingerprint] = (key.tripped_at, key.next_reset)
+            else:
+                entries.pop(key.fingerprint, None)
+        _save_limit_state(entries)
+
+def _parse_retry_after(value):
+    """
+    Разбирает заголовок Retry-After (секунды или HTTP дата).
+
+    Returns:
+        float: Задержка в секундах или None, если заголовок отсутствует или некорректен
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+# Общий пул соединений для всех запросов к API Ahrefs
+_api_url = urlparse(AHREFS_API_URL)
+_connection_pool = AhrefsConnectionPool(_api_url.netloc, scheme=_api_url.scheme)
+
+# Пул ключей API (состояние лимитов загружается ниже, вместе с остальным состоянием лимита)
+_key_pool = AhrefsKeyPool(AHREFS_API_KEYS)
+
+# Общий ограничитель запросов для всех запросов к API Ahrefs. Лимит частоты
+# у Ahrefs действует на ключ, поэтому с пулом ключей он растет пропорционально
+_key_count = max(1, len(_key_pool.keys))
+_rate_limiter = AdaptiveRateLimiter(AHREFS_RATE_LIMIT_RPM / 60 * _key_count, AHREFS_RATE_LIMIT_BURST * _key_count,
+                                    AHREFS_MAX_CONCURRENCY * _key_count)
+
+# Общий кэш ответов на диске
+_response_cache = AhrefsResponseCache()
+
+# Объединение одновременных одинаковых запросов (бот и планировщик в одном процессе)
+_single_flight = SingleFlight()
+
+# Общий подбор размера batch-analysis запросов
+_batch_sizer = AdaptiveBatchSizer()
+
+def _backoff_delay(attempt):
+    """Экспоненциальная задержка перед повтором с jitter (половина задержки случайна)"""
+    delay = min(AHREFS_RETRY_MAX_DELAY, AHREFS_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def _truncate(text, limit=AHREFS_LOG_BODY_MAX_CHARS):
+    """Обрезает тело ответа для записи в лог"""
+    if text is None:
+        return ""
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... ({len(text)} символів)"
+
+def _log_body(label, text):
+    """Пишет тело ответа в лог только в режиме DEBUG и только для выборки ответов"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < AHREFS_LOG_BODY_SAMPLE_RATE:
+        logger.debug(f"{label} тіло відповіді: {_truncate(text)}")
+
+def _log_request_event(method, endpoint, target, status, latency, response=None):
+    """
+    Пишет одно компактное событие на запрос: цель, статус, время, размер ответа и стоимость в units.
+    В режиме AHREFS_LOG_STRUCTURED событие пишется одной JSON строкой.
+
+    Размер ответа пишется дважды: bytes - тело после распаковки, wire_bytes - тело
+    в том виде, в каком пришло по сети (Content-Length; None, если заголовка нет).
+
+    Args:
+        target (str): Описание цели для лога (None - берется параметр target из query string)
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    path, _, query = endpoint.partition('?')
+    if target is None and query:
+        target = parse_qs(query).get('target', [None])[0]
+
+    size = wire_size = units = None
+    if response is not None:
+        size = len(response.text)
+        content_length = response.headers.get('Content-Length')
+        wire_size = int(content_length) if content_length and content_length.isdigit() else None
+        units = response.headers.get('x-api-units-cost-total-actual')
+
+    if AHREFS_LOG_STRUCTURED:
+        logger.info(json.dumps({
+            "event": "ahrefs_request", "method": method, "endpoint": path, "target": target,
+            "status": status, "latency_ms": round(latency * 1000), "bytes": size, "wire_bytes": wire_size,
+            "units": int(units) if units is not None and units.isdigit() else units
+        }, ensure_ascii=False))
+    else:
+        logger.info(f"{method} {path} target={target} status={status} {latency * 1000:.0f}ms "
+                    f"{size if size is not None else '-'}B (wire {wire_size if wire_size is not None else '-'}B) "
+                    f"units={units if units is not None else '-'}")
+
+def _ahrefs_request(method, endpoint, body=None, api_key=None, target=None):
+    """
+    Выполняет запрос к API Ahrefs (см. _send_request).
+
+    Одновременные одинаковые запросы (метод, endpoint, тело) объединяются:
+    уходит один запрос, и все вызывающие получают его ответ, поэтому API units
+    списываются один раз.
+
+    Args:
+        method (str): HTTP метод
+        endpoint (str): Путь запроса вместе с query string
+        body (str): JSON тело запроса (для POST)
+        api_key (AhrefsApiKey): Выполнить запрос именно этим ключом (по умолчанию ключ выбирает пул)
+        target (str): Описание цели для лога (по умолчанию - параметр target из query string)
+
+    Returns:
+        AhrefsResponse: Статус, заголовки и текст ответа
+    """
+    flight_key = (method, endpoint, body, api_key.fingerprint if api_key is not None else None)
+    return _single_flight.do(flight_key, lambda: _send_request(method, endpoint, body, api_key, target))
+
+def _send_request(method, endpoint, body=None, api_key=None, target=None):
+    """
+    Выполняет запрос к API Ahrefs через общий пул соединений и ограничитель запросов
+    и пишет в лог одно событие на запрос (с учетом всех повторов).
+
+    Запрос, получивший 429, ставится в очередь повторно (с учетом Retry-After),
+    а не отбрасывается. Ответ 429 возвращается вызывающему коду только если
+    исчерпаны повторы или сервер просит ждать дольше AHREFS_MAX_RETRY_AFTER.
+    Временные ошибки (5xx, 408, сетевые ошибки) повторяются до AHREFS_MAX_RETRIES
+    раз с экспоненциальной задержкой и jitter. Если ключ получил 403 из-за
+    исчерпанного лимита units, он отключается, а запрос повторяется с другим
+    ключом пула; такой 403 возвращается вызывающему коду, только когда лимит
+    достигнут на всех ключах. Другие 403 (неверный ключ, нет доступа к цели)
+    возвращаются как обычная ошибка запроса.
+
+    Args:
+        method (str): HTTP метод
+        endpoint (str): Путь запроса вместе с query string
+        body (str): JSON тело запроса (для POST)
+        api_key (AhrefsApiKey): Ключ для запроса (None - ключ выбирает пул)
+        target (str): Описание цели для лога
+
+    Returns:
+        AhrefsResponse: Статус, заголовки и текст ответа
+    """
+    headers = {
+        'Accept': "application/json",
+        'Accept-Encoding': "gzip, deflate"
+    }
+    if body is not None:
+        headers['Content-Type'] = "application/json"
+
+    started = time.monotonic()
+    try:
+        response = _request_with_retries(method, endpoint, body, headers, api_key)
+    except Exception as e:
+        _log_request_event(method, endpoint, target, type(e).__name__, time.monotonic() - started)
+        raise
+    _log_request_event(method, endpoint, target, response.status, time.monotonic() - started, response)
+    return response
+
+def _response_units(response):
+    """Стоимость запроса в API units из заголовка ответа (None, если заголовка нет)"""
+    units = response.headers.get('x-api-units-cost-total-actual')
+    return int(units) if units is not None and units.isdigit() else None
+
+def _request_timeout():
+    """
+    Таймаут чтения для очередной попытки: AHREFS_READ_TIMEOUT, но не дольше
+    времени, оставшегося на сбор данных до дедлайна запуска.
+
+    Raises:
+        DeadlineExceeded: Если время на сбор данных истекло
+    """
+    time_left = fetch_time_left()
+    if time_left is None:
+        return AHREFS_READ_TIMEOUT
+    if time_left <= 0:
+        raise DeadlineExceeded("Час на збір даних Ahrefs вичерпано")
+    return min(AHREFS_READ_TIMEOUT, time_left)
+
+def _can_wait(delay):
+    """Успеет ли запрос повториться после паузы delay до дедлайна запуска"""
+    time_left = fetch_time_left()
+    return time_left is None or time_left > delay
+
+def _request_with_retries(method, endpoint, body, headers, api_key=None):
+    """Отправляет запрос с повторами после 429, 403 и временных ошибок (см. _send_request)"""
+    throttled_attempts = 0
+    failed_attempts = 0
+    while True:
+        timeout = _request_timeout()
+        _rate_limiter.acquire()
+        key = _key_pool.acquire(pinned=api_key)
+        if key is None:
+            _rate_limiter.release()
+            # Лимит достигнут на всех ключах - запрос не отправляем
+            return AhrefsResponse(403, http.client.HTTPMessage(), "API units limit reached on all API keys")
+        try:
+            response = _connection_pool.request(method, endpoint, body=body, timeout=timeout,
+                                                headers=dict(headers, Authorization=f"Bearer {key.key}"))
+        except _TRANSIENT_ERRORS as e:
+            _key_pool.release(key)
+            _rate_limiter.release()
+            failed_attempts += 1
+            delay = _backoff_delay(failed_attempts)
+            if failed_attempts > AHREFS_MAX_RETRIES or not _can_wait(delay):
+                raise
+            logger.warning(f"Запит {endpoint.split('?')[0]} не вдався ({type(e).__name__}: {e}), "
+                           f"повтор через {delay:.1f} с ({failed_attempts}/{AHREFS_MAX_RETRIES})")
+            time.sleep(delay)
+            continue
+        except Exception:
+            _key_pool.release(key)
+            _rate_limiter.release()
+            raise
+
+        _key_pool.release(key, _response_units(response))
+        if _is_units_limit_response(response.status, response.text) and api_key is None and _key_pool.trip(key):
+            _rate_limiter.release()
+            logger.warning(f"Запит {endpoint.split('?')[0]} повторюємо з іншим ключем API")
+            continue
+
+        if response.status != 429:
+            _rate_limiter.release()
+            delay = _backoff_delay(failed_attempts + 1)
+            if (response.status in _TRANSIENT_STATUSES and failed_attempts < AHREFS_MAX_RETRIES
+                    and _can_wait(delay)):
+                failed_attempts += 1
+                logger.warning(f"Запит {endpoint.split('?')[0]} повернув {response.status}, "
+                               f"повтор через {delay:.1f} с ({failed_attempts}/{AHREFS_MAX_RETRIES})")
+                time.sleep(delay)
+                continue
+            return response
+
+        retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+        _rate_limiter.release(throttled=True, retry_after=retry_after)
+        throttled_attempts += 1
+        if (throttled_attempts > AHREFS_MAX_THROTTLE_RETRIES or (retry_after or 0) > AHREFS_MAX_RETRY_AFTER
+                or not _can_wait(retry_after or 0)):
+            return response
+        logger.info(f"Запит {endpoint.split('?')[0]} повернуто в чергу після 429 "
+                    f"(спроба {throttled_attempts}/{AHREFS_MAX_THROTTLE_RETRIES})")
+
+def _next_limit_reset(now):
+    """Дата обновления лимитов API: 24 число текущего месяца или следующего, если 24 уже наступило"""
+    if now.day >= 24:
+        next_reset_month = now.month + 1 if now.month < 12 else 1
+        next_reset_year = now.year if now.month < 12 else now.year + 1
+    else:
+        next_reset_month = now.month
+        next_reset_year = now.year
+    return datetime(next_reset_year, next_reset_month, 24).date()
+
+def _clear_limit_state():
+    try:
+        os.remove(AHREFS_LIMIT_STATE_FILE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Не вдалося видалити файл стану ліміту API: {str(e)}")
+
+def _load_limit_state():
+    """
+    Загружает сохраненное состояние лимитов ключей API.
+
+    Записи, лимиты которых уже обновились, отбрасываются. Файл старого формата
+    (без отпечатков ключей) относится ко всем ключам и возвращается с ключом "*".
+
+    Returns:
+        dict: Словарь {отпечаток ключа: (время достижения лимита, дата обновления лимитов)}
+    """
+    try:
+        with open(AHREFS_LIMIT_STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        raw_entries = {"*": state} if "next_reset" in state else state.get("keys", {})
+        entries = {}
+        for fingerprint, entry in raw_entries.items():
+            entries[fingerprint] = (entry.get("tripped_at"),
+                                    datetime.strptime(entry["next_reset"], '%Y-%m-%d').date())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"Не вдалося прочитати файл стану ліміту API: {str(e)}")
+        return {}
+
+    today = datetime.now().date()
+    active = {fingerprint: entry for fingerprint, entry in entries.items() if today < entry[1]}
+    if len(active) != len(entries):
+        logger.info("Ліміти API оновилися - скидаємо збережений стан для оновлених ключів")
+        _save_limit_state(active)
+    return active
+
+def _save_limit_state(entries):
+    """Атомарно сохраняет состояние лимитов ключей API, чтобы его видели следующие запуски"""
+    if not entries:
+        _clear_limit_state()
+        return
+    state = {"keys": {
+        fingerprint: {
+            "tripped_at": tripped_at.isoformat(timespec='seconds') if isinstance(tripped_at, datetime) else tripped_at,
+            "next_reset": next_reset.strftime('%Y-%m-%d')
+        }
+        for fingerprint, (tripped_at, next_reset) in entries.items()
+    }}
+    directory = os.path.dirname(os.path.abspath(AHREFS_LIMIT_STATE_FILE))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, AHREFS_LIMIT_STATE_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logger.error(f"Не вдалося зберегти стан ліміту API: {str(e)}")
+
+# Состояние лимита переживает перезапуск процесса: пока лимит достигнут на всех
+# ключах, новые запуски до 24 числа не отправляют запросов
+_key_pool.load_state()
+_api_limit_reached = _key_pool.all_tripped
+
 def is_api_limit_reached():
     """Проверяет, достигнут ли лимит API"""
     return _api_limit_reached
 
 def reset_api_limit_flag():
-    """Сбрасывает флаг лимита API (для тестирования или нового цикла)"""
+    """Сбрасывает флаг лимита API и состояние всех ключей (для тестирования или нового цикла)"""
     global _api_limit_reached
     _api_limit_reached = False
+    _key_pool.reset_all()
+    _clear_limit_state()
     logger.info("Флаг лимита API скинуто")
 
 def should_skip_execution_due_to_limit():
     """
     Проверяет, нужно ли пропустить выполнение скрипта из-за достигнутого лимита API.
+    Учитывает лимит, достигнутый в предыдущих запусках (сохраняется в AHREFS_LIMIT_STATE_FILE).
 
     Returns:
-        bool: True если нужно пропустить выполнение (лимит достигнут и еще не 24 число)
+        bool: True если нужно пропустить выполнение (лимит достигнут и лимиты еще не обновились)
     """
+    global _api_limit_reached
     if not _api_limit_reached:
         return False
 
-    today = datetime.now()
+    today = datetime.now().date()
 
-    # Если лимит достигнут и сегодня 24 число или позже, автоматически сбрасываем флаг
-    if today.day >= 24:
-        logger.info(f"Сьогодні {today.day} число - автоматично скидаємо флаг ліміту API")
-        reset_api_limit_flag()
-        return False
+    # Если лимиты хотя бы одного ключа уже обновились, автоматически сбрасываем флаг
+    if _key_pool.reset_expired(today) or not _key_pool.keys:
+        logger.info("Ліміти API оновилися - автоматично скидаємо флаг ліміту API")
+        _api_limit_reached = _key_pool.all_tripped
+        if not _api_limit_reached:
+            return False
+
+    next_reset = _key_pool.next_reset() or _next_limit_reset(datetime.now())
 
-    # Если лимит достигнут и еще не 24 число - пропускаем выполнение
-    days_until_reset = 24 - today.day
+    # Если лимит достигнут и лимиты еще не обновились - пропускаем выполнение
+    days_until_reset = (next_reset - today).days
     logger.warning(f"⚠️ Ліміт API досягнуто. Виконання пропущено. До оновлення лімітів: {days_until_reset} дн. (24 число)")
     return True
 
 def get_api_limit_message():
     """Возвращает сообщение о достижении лимитов API для уведомлений"""
     if _api_limit_reached:
-        # Вычисляем дату следующего обновления лимитов (24 число следующего месяца)
+        # Дата следующего обновления лимитов (24 число)
         today = datetime.now()
-        if today.day >= 24:
-            # Если сегодня 24 или позже, лимиты обновятся 24 числа следующего месяца
-            next_reset_month = today.month + 1 if today.month < 12 else 1
-            next_reset_year = today.year if today.month < 12 else today.year + 1
-        else:
-            # Если сегодня до 24 числа, лимиты обновятся 24 числа текущего месяца
-            next_reset_month = today.month
-            next_reset_year = today.year
-
-        next_reset_date = datetime(next_reset_year, next_reset_month, 24)
-        days_until_reset = (next_reset_date.date() - today.date()).days
+        next_reset_date = _key_pool.next_reset() or _next_limit_reset(today)
+        days_until_reset = (next_reset_date - today.date()).days
 
         return f"🚫 *Увага!*\n\nДосягнуто ліміт API Ahrefs!\n\n" \
                f"📊 Збір даних трафіку призупинено до відновлення лімітів.\n" \
@@ -75,286 +971,733 @@ def get_api_limit_message():
                f"🔄 Скрипт автоматично відновить роботу після оновлення лімітів."
     return None
 
+def _is_units_limit_response(status_code, response_text):
+    """403 из-за исчерпанного лимита API units (а не неверного ключа или нет доступа к цели)"""
+    return status_code == 403 and "api units limit reached" in (response_text or "").lower()
+
 def _set_api_limit_reached(status_code, response_text=""):
-    """Устанавливает флаг лимита API при получении ошибки 403"""
+    """
+    Устанавливает флаг лимита API, если 403 означает исчерпанный лимит units.
+
+    До вызывающего кода такой 403 доходит, только когда лимит достигнут на всех
+    ключах пула; состояние каждого ключа уже сохранено пулом для следующих запусков.
+    Остальные 403 лимитом не считаются: запрос обрабатывается как неудачный.
+    """
     global _api_limit_reached
-    if status_code == 403:
+    if _is_units_limit_response(status_code, response_text):
         _api_limit_reached = True
         logger.error(f"🚫 ЛІМІТ API ДОСЯГНУТО! Статус: {status_code}. Подальші запити будуть пропущені.")
-        logger.error(f"Відповідь API: {response_text}")
-        
-        # Проверяем, содержит ли ответ информацию о лимитах
-        if "API units limit reached" in response_text:
-            logger.error("💥 API UNITS LIMIT EXCEEDED - потрібно зачекати до відновлення лімітів")
-        elif "Rate limit" in response_text:
-            logger.error("⏰ RATE LIMIT EXCEEDED - забагато запитів за короткий час")
-        
+        logger.error(f"Відповідь API: {_truncate(response_text)}")
+        logger.error("💥 API UNITS LIMIT EXCEEDED - потрібно зачекати до відновлення лімітів")
         return True
+    if status_code == 403:
+        logger.error(f"API Ahrefs відхилив запит (403), але це не ліміт units: {_truncate(response_text)}")
     return False
 
-def get_current_organic_traffic(domain):
+# Маркер отсутствующего пути в ответе (значение поля само может быть None)
+_PATH_NOT_FOUND = object()
+
+class ResponsePathExtractor:
+    """
+    Извлекает поле из ответов API, запоминая, где оно находится.
+
+    Для каждого endpoint'а путь к полю (последовательность ключей) ищется
+    рекурсивно только один раз и кэшируется. Дальше извлечение стоит
+    несколько обращений к словарям; рекурсивный поиск повторяется, только
+    если структура ответа изменилась и по сохраненному пути поля нет.
+
+    Args:
+        field (str): Имя поля, например "org_traffic"
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _follow(obj, path):
+        for key in path:
+            if not isinstance(obj, dict) or key not in obj:
+                return _PATH_NOT_FOUND
+            obj = obj[key]
+        return obj
+
+    def _find_path(self, obj, prefix=()):
+        """Рекурсивный поиск пути к полю (ключи текущего уровня проверяются раньше вложенных)"""
+        if not isinstance(obj, dict):
+            return None
+        if self.field in obj:
+            return prefix + (self.field,)
+        for key, value in obj.items():
+            path = self._find_path(value, prefix + (key,))
+            if path is not None:
+                return path
+        return None
+
+    def extract(self, endpoint, obj):
+        """
+        Извлекает значение поля из ответа endpoint'а.
+
+        Returns:
+            Значение поля или None, если поля в ответе нет
+        """
+        path = self._paths.get(endpoint)
+        if path is not None:
+            value = self._follow(obj, path)
+            if value is not _PATH_NOT_FOUND:
+                return value
+
+        path = self._find_path(obj)
+        if path is None:
+            return None
+        with self._lock:
+            if self._paths.get(endpoint) != path:
+                logger.info(f"Шлях до {self.field} у відповіді {endpoint}: {'.'.join(map(str, path))}")
+                self._paths[endpoint] = path
+        return self._follow(obj, path)
+
+# Извлечение org_traffic из ответов metrics и batch-analysis
+_org_traffic_extractor = ResponsePathExtractor("org_traffic")
+
+# Извлечение дополнительных метрик из тех же ответов
+_metric_extractors = {field: ResponsePathExtractor(field) for field in AHREFS_EXTRA_METRICS}
+
+def _extract_metrics(endpoint, obj):
+    """Дополнительные метрики из ответа endpoint'а: словарь {поле: значение} только для найденных полей"""
+    metrics = {}
+    for field, extractor in _metric_extractors.items():
+        value = extractor.extract(endpoint, obj)
+        if value is not None:
+            metrics[field] = value
+    return metrics
+
+def _cache_mode(target):
+    """Режим цели для ключа кэша: трафик по стране хранится отдельно от общего"""
+    return f"{target.mode}:{target.country}" if target.country else target.mode
+
+def _cached_traffic(target, date, endpoints):
+    """
+    Ищет трафик цели в кэше ответов.
+
+    Args:
+        target (AhrefsTarget): Цель запроса
+        date (str): Дата данных
+        endpoints (tuple): Endpoint'ы, ответы которых подходят (в порядке проверки)
+
+    Returns:
+        TrafficResult: Трафик и дополнительные метрики из кэша или None, если в кэше их нет
+    """
+    for endpoint in endpoints:
+        cached = _response_cache.get(target.target, _cache_mode(target), "average", date, endpoint)
+        if cached is not None:
+            traffic = _org_traffic_extractor.extract(endpoint, cached)
+            if traffic is not None:
+                return TrafficResult.ok(traffic, _extract_metrics(endpoint, cached))
+    return None
+
+def fetch_current_organic_traffic(domain):
     """
     ОПТИМИЗИРОВАННАЯ ВЕРСИЯ: Получает только ТЕКУЩИЙ органический трафик для домена.
     Вместо запроса месячной истории получает актуальные данные за сегодня.
     
     Args:
-        domain (str): Домен для проверки
+        domain (str | AhrefsTarget): Домен, URL или уже нормализованная цель
+                                     (цель со страной - трафик только из этой страны)
         
     Returns:
-        int: Значение органического трафика или 0 в случае ошибки
+        TrafficResult: Значение трафика, отсутствующее значение или достигнутый лимит API
     """
+    try:
+        target = normalize_target(domain)
+    except ValueError as e:
+        logger.error(str(e))
+        return TrafficResult.missing()
+    domain = f"{target.target} {target.country.upper()}" if target.country else target.target
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    
+    # Повторный запрос за ту же дату берем из кэша, не расходуя API units
+    cached_result = _cached_traffic(target, current_date, (METRICS_ENDPOINT, BATCH_ENDPOINT))
+    if cached_result is not None:
+        logger.info(f"[{domain}] Трафік з кешу: {cached_result.value}")
+        return cached_result
+    
     # Проверяем, не достигнут ли лимит API
     if _api_limit_reached:
         logger.warning(f"[{domain}] ⚠️ Пропускаємо запит - ліміт API вже досягнуто")
-        return None  # Возвращаем None вместо 0 для индикации недоступности API
+        return TrafficResult.limit_reached()
     
     response_text = None
     try:
-        if not AHREFS_API_KEY:
+        if not AHREFS_API_KEYS:
             logger.error("AHREFS_API_KEY не знайдений в змінних середовища")
-            return 0
+            return TrafficResult.missing()
         
-        logger.info(f"[{domain}] ОПТИМІЗОВАНИЙ запит - отримуємо тільки поточний трафік")
+        logger.debug(f"[{domain}] ОПТИМІЗОВАНИЙ запит - отримуємо тільки поточний трафік")
 
-        conn = http.client.HTTPSConnection("api.ahrefs.com")
-        
-        headers = {
-            'Accept': "application/json",
-            'Authorization': f"Bearer {AHREFS_API_KEY}"
-        }
-        
         # ОПТИМИЗАЦИЯ: используем metrics endpoint с volume_mode=average для консистентности
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        endpoint = f"/v3/site-explorer/metrics?target={domain}&mode=domain&volume_mode=average&date={current_date}"
+        endpoint = (f"{METRICS_ENDPOINT}?target={quote(target.target, safe='')}&mode={target.mode}"
+                    f"&volume_mode=average&date={current_date}")
+        if target.country:
+            endpoint += f"&country={target.country}"
         
-        logger.info(f"[{domain}] Оптимізований endpoint: {endpoint}")
+        logger.debug(f"[{domain}] Оптимізований endpoint: {endpoint}")
         
-        conn.request("GET", endpoint, headers=headers)
-        response = conn.getresponse()
-        data = response.read()
-        response_text = data.decode("utf-8")
+        response = _ahrefs_request("GET", endpoint)
+        response_text = response.text
         
-        logger.info(f"[{domain}] Статус відповіді: {response.status}")
+        logger.debug(f"[{domain}] Статус відповіді: {response.status}")
         
         # Проверяем на лимит API (403)
         if _set_api_limit_reached(response.status, response_text):
-            return None  # Возвращаем None при достижении лимитов
+            return TrafficResult.limit_reached()
         
         if response.status == 200:
             try:
                 json_data = json.loads(response_text)
             except json.JSONDecodeError as e:
                 logger.error(f"[{domain}] Помилка парсингу JSON: {e}")
-                logger.error(f"[{domain}] Перші 500 символів відповіді: {response_text[:500]}")
-                return 0
-            
-            # Логируем полную структуру для отладки (GitHub Actions замаскирует чувствительные данные)
-            logger.info(f"[{domain}] Успішна відповідь: {response_text}")
+                logger.error(f"[{domain}] Відповідь: {_truncate(response_text)}")
+                return TrafficResult.missing()
             
-            # Проверяем структуру ответа детально
-            logger.info(f"[{domain}] Тип відповіді: {type(json_data)}")
-            logger.info(f"[{domain}] Ключі верхнього рівня: {list(json_data.keys()) if isinstance(json_data, dict) else 'Не словник'}")
+            # Тело ответа пишется только в режиме DEBUG и только для выборки ответов
+            _log_body(f"[{domain}]", response_text)
             
-            # Пробуем получить данные напрямую из корня (для совместимости со старым API)
-            traffic = json_data.get("org_traffic", 0) if isinstance(json_data, dict) else 0
-            
-            # Если не нашли в корне, ищем в metrics
-            if traffic == 0 and isinstance(json_data, dict) and "metrics" in json_data:
-                metrics = json_data.get("metrics", {})
-                logger.info(f"[{domain}] Знайдено об'єкт metrics, ключі: {list(metrics.keys()) if isinstance(metrics, dict) else 'Не словник'}")
-                traffic = metrics.get("org_traffic", 0) if isinstance(metrics, dict) else 0
-            
-            # Дополнительная проверка - может данные во вложенном объекте metrics.metrics
-            if traffic == 0 and isinstance(json_data, dict):
-                # Рекурсивный поиск org_traffic
-                def find_org_traffic(obj, path=""):
-                    if isinstance(obj, dict):
-                        if "org_traffic" in obj:
-                            logger.info(f"[{domain}] Знайдено org_traffic по шляху {path}: {obj['org_traffic']}")
-                            return obj["org_traffic"]
-                        for key, value in obj.items():
-                            result = find_org_traffic(value, f"{path}.{key}")
-                            if result is not None:
-                                return result
-                    return None
-                
-                found_traffic = find_org_traffic(json_data)
-                if found_traffic is not None:
-                    traffic = found_traffic
+            traffic = _org_traffic_extractor.extract(METRICS_ENDPOINT, json_data)
+            if traffic is None:
+                logger.warning(f"[{domain}] Не знайдено org_traffic у відповіді - значення відсутнє")
+                return TrafficResult.missing()
             
+            result = TrafficResult.ok(traffic, _extract_metrics(METRICS_ENDPOINT, json_data))
+            _response_cache.set(target.target, _cache_mode(target), "average", current_date, METRICS_ENDPOINT, json_data)
             logger.info(f"[{domain}] Фінальний трафік: {traffic}")
-            return int(traffic)
+            return result
             
         elif response.status == 401:
             logger.error(f"[{domain}] Помилка авторизації API Ahrefs")
-            logger.error(f"[{domain}] Відповідь: {response_text}")
-            return 0
+            logger.error(f"[{domain}] Відповідь: {_truncate(response_text)}")
+            return TrafficResult.missing()
         elif response.status == 429:
             logger.error(f"[{domain}] Перевищено ліміт запитів до API Ahrefs")
-            logger.error(f"[{domain}] Відповідь: {response_text}")
-            return 0
+            logger.error(f"[{domain}] Відповідь: {_truncate(response_text)}")
+            return TrafficResult.missing()
         else:
             logger.error(f"[{domain}] Помилка API Ahrefs ({response.status})")
-            logger.error(f"[{domain}] Відповідь: {response_text}")
-            return 0
+            logger.error(f"[{domain}] Відповідь: {_truncate(response_text)}")
+            return TrafficResult.missing()
             
-    except json.JSONDecodeError as e:
+    except DeadlineExceeded:
+        logger.warning(f"[{domain}] ⏱ Запит не виконано - час на збір даних вичерпано")
+        return TrafficResult.missing()
+    except TimeoutError:
+        logger.error(f"[{domain}] API Ahrefs не відповів за {AHREFS_READ_TIMEOUT:g} с, повтори вичерпано")
+        return TrafficResult.missing()
+    except (json.JSONDecodeError, TypeError, ValueError) as e:
         logger.error(f"[{domain}] Помилка при розборі JSON відповіді: {str(e)}")
         if response_text:
-            logger.error(f"[{domain}] Отриманий текст: {response_text}")
-        return 0
+            logger.error(f"[{domain}] Отриманий текст: {_truncate(response_text)}")
+        return TrafficResult.missing()
     except Exception as e:
         logger.error(f"[{domain}] Неочікувана помилка: {str(e)}")
         import traceback
         logger.error(f"[{domain}] Traceback: {traceback.format_exc()}")
-        return 0
-    finally:
-        conn.close()
+        return TrafficResult.missing()
 
-def get_batch_organic_traffic(domains_batch):
+def get_current_organic_traffic(domain):
     """
-    ОПТИМИЗИРОВАННЫЙ BATCH ЗАПРОС: Использует правильный /batch-analysis endpoint.
-    Получает трафик для нескольких доменов за один API вызов с volume_mode=average.
-    
+    Получает текущий органический трафик домена.
+
+    Args:
+        domain (str): Домен для проверки
+
+    Returns:
+        int: Значение органического трафика или None, если значение получить не удалось
+             (в том числе при достигнутом лимите API)
+    """
+    return fetch_current_organic_traffic(domain).value
+
+def fetch_traffic_history(domain, date_from, date_to):
+    """
+    Получает недельную историю органического трафика одним запросом metrics-history.
+
     Args:
-        domains_batch (list): Список доменов (максимум 50 доменов за раз)
+        domain (str | AhrefsTarget): Домен, URL или уже нормализованная цель
+        date_from (str): Начало периода (YYYY-MM-DD)
+        date_to (str): Конец периода (YYYY-MM-DD)
+
+    Returns:
+        dict: Словарь {дата: трафик} по неделям или None, если историю получить не удалось
+              (в том числе при достигнутом лимите API)
+    """
+    try:
+        target = normalize_target(domain)
+    except ValueError as e:
+        logger.error(str(e))
+        return None
+    domain = target.target
+    period = f"{date_from}:{date_to}"
+    
+    json_data = _response_cache.get(target.target, target.mode, "average", period, HISTORY_ENDPOINT)
+    if json_data is None:
+        if _api_limit_reached:
+            logger.warning(f"[{domain}] ⚠️ Пропускаємо запит історії - ліміт API вже досягнуто")
+            return None
+        if not AHREFS_API_KEYS:
+            logger.error("AHREFS_API_KEY не знайдений в змінних середовища")
+            return None
+        
+        endpoint = (f"{HISTORY_ENDPOINT}?target={quote(target.target, safe='')}&mode={target.mode}"
+                    f"&date_from={date_from}&date_to={date_to}&history_grouping=weekly"
+                    f"&volume_mode=average&select=date,org_traffic")
+        try:
+            response = _ahrefs_request("GET", endpoint)
+        except Exception as e:
+            logger.error(f"[{domain}] Помилка запиту історії трафіку: {str(e)}")
+            return None
         
+        if _set_api_limit_reached(response.status, response.text):
+            return None
+        if response.status != 200:
+            logger.error(f"[{domain}] Помилка API Ahrefs при запиті історії ({response.status}): {_truncate(response.text)}")
+            return None
+        try:
+            json_data = json.loads(response.text)
+        except json.JSONDecodeError as e:
+            logger.error(f"[{domain}] Помилка парсингу JSON історії: {e}")
+            return None
+        _response_cache.set(target.target, target.mode, "average", period, HISTORY_ENDPOINT, json_data)
+    
+    points = json_data.get("metrics") if isinstance(json_data, dict) else json_data
+    if not isinstance(points, list):
+        logger.warning(f"[{domain}] Неочікуваний формат відповіді історії: {_truncate(str(json_data))}")
+        return None
+    
+    history = {}
+    for point in points:
+        if not isinstance(point, dict) or not point.get("date"):
+            continue
+        traffic = _org_traffic_extractor.extract(HISTORY_ENDPOINT, point)
+        if traffic is not None:
+            history[str(point["date"])[:10]] = traffic
+    
+    logger.info(f"[{domain}] Історія трафіку: {len(history)} тижнів за {date_from} - {date_to}")
+    return history
+
+# Маркер домена, запрос для которого не отправлялся из-за достигнутого лимита API
+_SKIPPED = object()
+
+def _deadline_reached():
+    """Истекло ли время на сбор данных (с учетом резерва на запись и уведомления)"""
+    time_left = fetch_time_left()
+    return time_left is not None and time_left <= 0
+
+def _fetch_unless_limit_reached(target):
+    if _api_limit_reached or _deadline_reached():
+        return _SKIPPED
+    return fetch_current_organic_traffic(target)
+
+def _fetch_individually(targets):
+    """
+    Fallback для batch запроса: получает трафик каждого домена отдельным запросом
+    на ограниченном пуле потоков.
+
+    Как только один из запросов получает 403 (лимит API), запросы, которые еще
+    не начались, отменяются, а уже запущенные потоки не отправляют новых запросов.
+
+    Args:
+        targets (list): Список целей (AhrefsTarget)
+
+    Returns:
+        dict: Словарь {AhrefsTarget: TrafficResult} в порядке исходного списка,
+              только для целей, запрос для которых был выполнен
+    """
+    executor = ThreadPoolExecutor(max_workers=AHREFS_FALLBACK_WORKERS)
+    futures = {target: executor.submit(_fetch_unless_limit_reached, target) for target in targets}
+    try:
+        for _ in as_completed(futures.values()):
+            # Если в процессе индивидуальных запросов достигли лимита, прекращаем
+            if _api_limit_reached or _deadline_reached():
+                logger.warning("Ліміт API або час запуску вичерпано під час fallback запитів. Припиняємо обробку.")
+                executor.shutdown(wait=False, cancel_futures=True)
+                break
+    finally:
+        # Дожидаемся запросов, которые уже были отправлены
+        executor.shutdown(wait=True)
+
+    results = {}
+    for target, future in futures.items():
+        if future.cancelled():
+            continue
+        traffic = future.result()
+        if traffic is not _SKIPPED:
+            results[target] = traffic
+    return results
+
+def _split_cached(targets, current_date):
+    """
+    Разделяет batch на цели, данные которых за сегодня уже есть в кэше, и остальные.
+
     Returns:
-        dict: Словарь {domain: traffic_value}
+        tuple: (словарь {AhrefsTarget: TrafficResult} из кэша, список целей для запроса)
     """
     results = {}
+    for target in targets:
+        cached_result = _cached_traffic(target, current_date, (BATCH_ENDPOINT, METRICS_ENDPOINT))
+        if cached_result is not None:
+            results[target] = cached_result
+    uncached_batch = [target for target in targets if target not in results]
     
-    # Проверяем, не достигнут ли лимит API
-    if _api_limit_reached:
-        logger.warning(f"⚠️ Пропускаємо BATCH запит для {len(domains_batch)} доменів - ліміт API вже досягнуто")
-        # Возвращаем нулевые значения для всех доменов
-        for domain in domains_batch:
-            results[domain] = 0
-        return results
+    if results:
+        logger.info(f"BATCH: {len(results)} доменів взято з кешу, запитуємо {len(uncached_batch)}")
+    return results, uncached_batch
+
+def _request_batch(uncached_batch, mode, current_date, select=BATCH_SELECT_FIELDS):
+    """
+    Отправляет batch-analysis запрос (сетевая часть batch запроса).
+    Все цели batch'а имеют один режим mode и одну страну. Время, статус и размер
+    ответа учитываются при подборе размера следующих batch'ей.
+
+    Args:
+        select (list): Поля ответа (по умолчанию - только поля, которые читает конвейер)
+
+    Returns:
+        AhrefsResponse: Ответ API
+    """
+    target_names = [target.target for target in uncached_batch]
+    country = uncached_batch[0].country
+    logger.info(f"BATCH ANALYSIS запит ({mode}{', ' + country.upper() if country else ''}) "
+                f"для {len(target_names)} цілей")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"BATCH цілі: {target_names}")
     
-    if not AHREFS_API_KEY:
-        logger.error("AHREFS_API_KEY не знайдений в змінних середовища")
-        return results
+    # Правильный batch endpoint с POST запросом
+    endpoint = BATCH_ENDPOINT
     
-    if not domains_batch:
-        return results
-        
-    # Ограничиваем размер batch до 50 доменов
-    batch_size = min(len(domains_batch), 50)
-    current_batch = domains_batch[:batch_size]
+    # Формируем JSON body для batch запроса
+    request_body = {
+        "targets": target_names,
+        "mode": mode,
+        "volume_mode": "average",  # Используем режим average как указано
+        "date": current_date,  # Текущая дата
+        "select": select  # Только нужные поля: меньше ответ и быстрее разбор
+    }
+    if country:
+        request_body["country"] = country
     
-    logger.info(f"BATCH ANALYSIS запит для {len(current_batch)} доменів: {current_batch}")
+    json_body = json.dumps(request_body)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"BATCH body: {_truncate(json_body)}")
     
     try:
-        conn = http.client.HTTPSConnection("api.ahrefs.com")
-        
-        headers = {
-            'Accept': "application/json",
-            'Authorization': f"Bearer {AHREFS_API_KEY}",
-            'Content-Type': "application/json"
-        }
-        
-        # Правильный batch endpoint с POST запросом
-        endpoint = "/v3/site-explorer/batch-analysis"
-        
-        # Формируем JSON body для batch запроса
-        request_body = {
-            "targets": current_batch,
-            "mode": "domain",
-            "volume_mode": "average",  # Используем режим average как указано
-            "date": datetime.now().strftime('%Y-%m-%d')  # Текущая дата
-        }
-        
-        json_body = json.dumps(request_body)
-        logger.info(f"BATCH endpoint: {endpoint}")
-        logger.info(f"BATCH body: {json_body}")
-        
-        conn.request("POST", endpoint, body=json_body, headers=headers)
-        response = conn.getresponse()
-        data = response.read()
-        response_text = data.decode("utf-8")
-        
-        logger.info(f"BATCH статус відповіді: {response.status}")
-        
-        # Проверяем на лимит API (403) для batch запроса
-        if _set_api_limit_reached(response.status, response_text):
-            # Возвращаем нулевые значения для всех доменов в batch
-            for domain in current_batch:
-                results[domain] = 0
-            return results
+        response = _ahrefs_request("POST", endpoint, body=json_body, target=f"{len(target_names)} targets")
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        _batch_sizer.record(len(target_names), failed=True)
+        raise
+    # 429 и 403 не зависят от размера batch'а и на него не влияют
+    if response.status == 200 or response.status in _TRANSIENT_STATUSES:
+        _batch_sizer.record(len(target_names), response.elapsed,
+                            failed=response.status != 200, response_bytes=len(response.text))
+    return response
+
+def _submit_batch(executor, batch, current_date):
+    """
+    Проверяет кэш и лимиты и, если нужно, отправляет batch запрос в executor.
+
+    Args:
+        batch (TargetBatch): Однородный batch целей
+
+    Returns:
+        tuple: (batch, результаты из кэша, цели для запроса, future запроса или None)
+    """
+    results, uncached_batch = _split_cached(batch.targets, current_date)
+    future = None
+    if uncached_batch and not _api_limit_reached and not _deadline_reached() and AHREFS_API_KEYS:
+        future = executor.submit(_request_batch, uncached_batch, batch.mode, current_date)
+    return batch, results, uncached_batch, future
+
+def _match_batch_target(item, idx, uncached_batch):
+    """
+    Находит цель запроса, к которой относится объект из ответа batch-analysis.
+
+    Сначала используется поле index, затем target/url (как отправлено или
+    после нормализации с режимом batch'а).
+
+    Returns:
+        AhrefsTarget: Цель или None, если объект не удалось сопоставить
+    """
+    index = item.get("index")
+    if isinstance(index, int) and 0 <= index < len(uncached_batch):
+        return uncached_batch[index]
+
+    name = item.get("target") or item.get("url")
+    if not name:
+        return None
+    by_name = {target.target: target for target in uncached_batch}
+    if name in by_name:
+        return by_name[name]
+    try:
+        normalized = normalize_target(f"{uncached_batch[0].mode}:{name}")
+    except ValueError:
+        logger.warning(f"[BATCH] Не вдалося розібрати ціль '{name}' в об'єкті {idx}")
+        return None
+    return by_name.get(normalized.target)
+
+def _parse_batch_response(response, uncached_batch, mode, current_date):
+    """
+    Разбирает ответ на batch запрос. Если batch не удался, его цели
+    запрашиваются повторно batch'ами меньшего размера (см. _refetch_failed_batch).
+
+    Args:
+        response (AhrefsResponse): Ответ API
+
+    Returns:
+        dict: Словарь {AhrefsTarget: TrafficResult} для целей, значение которых получено
+    """
+    results = {}
+    response_text = response.text
+    logger.debug(f"BATCH статус відповіді: {response.status}")
+    
+    # Проверяем на лимит API (403) для batch запроса
+    if _set_api_limit_reached(response.status, response_text):
+        for target in uncached_batch:
+            results[target] = TrafficResult.limit_reached()
+        return results
+    
+    if response.status == 200:
+        json_data = json.loads(response_text)
+        _log_body("BATCH", response_text)
         
-        if response.status == 200:
-            json_data = json.loads(response_text)
-            logger.info(f"BATCH успішна відповідь отримана")
-            
-            # Обрабатываем batch ответ - ожидаем массив объектов
-            if isinstance(json_data, list):
-                for idx, domain_data in enumerate(json_data):
-                    target = domain_data.get("target", "")
-                    
-                    # Рекурсивный поиск org_traffic в объекте
-                    def find_org_traffic(obj, path=""):
-                        if isinstance(obj, dict):
-                            if "org_traffic" in obj:
-                                return obj["org_traffic"]
-                            for key, value in obj.items():
-                                result = find_org_traffic(value, f"{path}.{key}")
-                                if result is not None:
-                                    return result
-                        return None
-                    
-                    traffic = find_org_traffic(domain_data)
-                    if traffic is None:
-                        traffic = 0
-                        logger.warning(f"[BATCH] Не знайдено org_traffic для {target} в об'єкті {idx}")
-                    
-                    if target:
-                        results[target] = int(traffic)
-                        logger.info(f"[BATCH] {target}: {traffic}")
-            else:
-                # Если ответ в другом формате
-                logger.warning(f"Неочікуваний формат відповіді BATCH: {json_data}")
+        # Обрабатываем batch ответ - ожидаем массив объектов (или объект со списком targets)
+        if isinstance(json_data, dict) and isinstance(json_data.get("targets"), list):
+            json_data = json_data["targets"]
+        if isinstance(json_data, list):
+            for idx, domain_data in enumerate(json_data):
+                target = _match_batch_target(domain_data, idx, uncached_batch)
+                if target is None:
+                    logger.warning(f"[BATCH] Не вдалося зіставити об'єкт {idx} з ціллю запиту")
+                    continue
                 
+                traffic = _org_traffic_extractor.extract(BATCH_ENDPOINT, domain_data)
+                if traffic is None:
+                    logger.warning(f"[BATCH] Не знайдено org_traffic для {target.target} в об'єкті {idx}")
+                    continue
+                
+                results[target] = TrafficResult.ok(traffic, _extract_metrics(BATCH_ENDPOINT, domain_data))
+                _response_cache.set(target.target, _cache_mode(target), "average", current_date, BATCH_ENDPOINT, domain_data)
+                logger.debug(f"[BATCH] {target.target}: {traffic}")
         else:
-            logger.error(f"BATCH помилка API Ahrefs ({response.status})")
-            logger.error(f"BATCH відповідь: {response_text}")
+            # Если ответ в другом формате
+            logger.warning(f"Неочікуваний формат відповіді BATCH: {_truncate(response_text)}")
             
-            # Fallback: пробуем индивидуальные запросы только если лимит не достигнут
-            if not _api_limit_reached:
-                logger.info("Fallback до індивідуальних запитів")
-                for domain in current_batch:
-                    results[domain] = get_current_organic_traffic(domain)
-                    # Если в процессе индивидуальных запросов достигли лимита, прекращаем
-                    if _api_limit_reached:
-                        logger.warning("Ліміт API досягнуто під час fallback запитів. Припиняємо обробку.")
-                        break
-            else:
-                # Если лимит уже достигнут, возвращаем нули
-                for domain in current_batch:
-                    results[domain] = 0
-                
+    elif response.status == 429:
+        # Повторы уже исчерпаны ограничителем - индивидуальные запросы только усилят перегрузку
+        logger.error(f"BATCH перевищено ліміт запитів до API Ahrefs, повтори вичерпано")
+        logger.error(f"BATCH відповідь: {_truncate(response_text)}")
+        
+    else:
+        logger.error(f"BATCH помилка API Ahrefs ({response.status})")
+        logger.error(f"BATCH відповідь: {_truncate(response_text)}")
+        results.update(_refetch_failed_batch(uncached_batch, mode, current_date))
+    
+    return results
+
+def _refetch_failed_batch(uncached_batch, mode, current_date):
+    """
+    Повторно запрашивает цели неудавшегося batch'а: двумя batch'ами вдвое
+    меньшего размера, а batch минимального размера - индивидуальными запросами.
+    Так сбой большого batch'а не превращается сразу в медленные запросы по одному домену.
+
+    Returns:
+        dict: Словарь {AhrefsTarget: TrafficResult} для целей, запрос для которых был выполнен
+    """
+    # Пробуем повторить только если лимит не достигнут и время не истекло
+    if _api_limit_reached or _deadline_reached():
+        return {}
+    
+    if len(uncached_batch) <= _batch_sizer.min_size:
+        logger.info("Fallback до індивідуальних запитів")
+        return _fetch_individually(uncached_batch)
+    
+    half = (len(uncached_batch) + 1) // 2
+    logger.info(f"Повторюємо BATCH з {len(uncached_batch)} цілей двома batch'ами по {half}")
+    results = {}
+    for part in (uncached_batch[:half], uncached_batch[half:]):
+        if _api_limit_reached or _deadline_reached():
+            break
+        try:
+            response = _request_batch(part, mode, current_date)
+            results.update(_parse_batch_response(response, part, mode, current_date))
+        except DeadlineExceeded:
+            break
+        except Exception as e:
+            logger.error(f"BATCH неочікувана помилка: {str(e)}")
+            results.update(_refetch_failed_batch(part, mode, current_date))
+    return results
+
+def _collect_batch(submitted, current_date):
+    """
+    Дожидается ответа на batch запрос и разбирает его (с повтором меньшими batch'ами
+    и fallback на индивидуальные запросы).
+
+    Args:
+        submitted (tuple): Результат _submit_batch
+        current_date (str): Дата данных
+
+    Returns:
+        dict: Словарь {AhrefsTarget: TrafficResult} для всех целей batch'а
+    """
+    current_batch, results, uncached_batch, future = submitted
+    if not uncached_batch:
+        return results
+    
+    if future is None:
+        # Проверяем, не достигнут ли лимит API
+        if _api_limit_reached:
+            logger.warning(f"⚠️ Пропускаємо BATCH запит для {len(uncached_batch)} цілей - ліміт API вже досягнуто")
+            for target in uncached_batch:
+                results[target] = TrafficResult.limit_reached()
+        elif _deadline_reached():
+            logger.warning(f"⏱ Пропускаємо BATCH запит для {len(uncached_batch)} цілей - час на збір даних вичерпано")
+            for target in uncached_batch:
+                results[target] = TrafficResult.missing()
+        else:
+            logger.error("AHREFS_API_KEY не знайдений в змінних середовища")
+            for target in uncached_batch:
+                results[target] = TrafficResult.missing()
+        return results
+    
+    try:
+        response = future.result()
+        results.update(_parse_batch_response(response, uncached_batch, current_batch.mode, current_date))
+    except DeadlineExceeded:
+        # Повторные запросы тоже не успеют - цели помечаются как отсутствующие ниже
+        logger.warning(f"⏱ BATCH запит для {len(uncached_batch)} цілей не завершено - час на збір даних вичерпано")
     except Exception as e:
         logger.error(f"BATCH неочікувана помилка: {str(e)}")
         import traceback
         logger.error(f"BATCH traceback: {traceback.format_exc()}")
-        # Fallback: пробуем индивидуальные запросы только если лимит не достигнут
-        if not _api_limit_reached:
-            logger.info("Fallback до індивідуальних запитів через помилку")
-            for domain in current_batch:
-                results[domain] = get_current_organic_traffic(domain)
-                # Если в процессе индивидуальных запросов достигли лимита, прекращаем
-                if _api_limit_reached:
-                    logger.warning("Ліміт API досягнуто під час fallback запитів через помилку. Припиняємо обробку.")
-                    break
-        else:
-            # Если лимит уже достигнут, возвращаем нули
-            for domain in current_batch:
-                results[domain] = 0
-    finally:
-        conn.close()
+        # Повторяем меньшими batch'ами (только если лимит не достигнут)
+        results.update(_refetch_failed_batch(uncached_batch, current_batch.mode, current_date))
+    
+    # Цели без значения явно помечаем как отсутствующие, чтобы их не приняли за нулевой трафик
+    for target in current_batch.targets:
+        if target not in results:
+            results[target] = TrafficResult.limit_reached() if _api_limit_reached else TrafficResult.missing()
         
     return results
 
+def iter_sized_batches(domains, batch_size=None, country=None):
+    """
+    Разбивает записи на однородные по режиму batch'и, размер которых
+    определяется в момент, когда batch запрашивается: так на размер
+    следующих batch'ей влияют ответы на предыдущие (AdaptiveBatchSizer).
+
+    Порядок приоритета записей сохраняется: следующим идет batch того режима,
+    чья очередная цель стоит в списке раньше. Поэтому при нехватке времени
+    пропускаются наименее приоритетные цели, а не все цели "поздних" режимов.
+
+    Args:
+        domains (list): Записи из списка доменов (по убыванию приоритета)
+        batch_size (int): Фиксированный размер batch'а (None - подбирается автоматически)
+        country (str): Страна, для которой запрашивается трафик (None - весь трафик)
+
+    Yields:
+        TargetBatch: Очередной batch. Записи, которые не удалось нормализовать, пропускаются
+    """
+    groups = batch_targets(domains, max(1, len(domains)), country)
+    position = {}
+    for index, entry in enumerate(domains):
+        position.setdefault(entry, index)
+    # Место цели в списке - по первой из ее записей; внутри режима цели уже упорядочены
+    ranks = [[min(position[entry] for entry in group.entries[target]) for target in group.targets]
+             for group in groups]
+    starts = [0] * len(groups)
+    while True:
+        pending = [index for index, group in enumerate(groups) if starts[index] < len(group.targets)]
+        if not pending:
+            return
+        index = min(pending, key=lambda i: ranks[i][starts[i]])
+        group = groups[index]
+        size = max(1, min(batch_size or _batch_sizer.size, MAX_BATCH_SIZE))
+        chunk = group.targets[starts[index]:starts[index] + size]
+        starts[index] += len(chunk)
+        yield TargetBatch(group.mode, chunk, {target: group.entries[target] for target in chunk}, country)
+
+def iter_batch_organic_traffic(domains, batch_size=None, country=None):
+    """
+    Получает трафик для любого количества доменов batch запросами, выдавая
+    результаты по мере готовности каждого batch'а.
+
+    Записи нормализуются (ahrefs_targets): дубли запрашиваются один раз, а
+    batch'и группируются по режиму Ahrefs, чтобы каждый запрос был однородным
+    и заполненным. Результаты возвращаются для исходных записей.
+
+    Запросы конвейеризированы: пока разбирается ответ на текущий batch,
+    запрос следующего batch'а уже отправлен.
+
+    Args:
+        domains (list): Список доменов и URL (любое количество)
+        batch_size (int): Количество целей в одном batch запросе (не больше MAX_BATCH_SIZE;
+                          None - размер подбирается по ответам API)
+        country (str): Двухбуквенный код страны - трафик только из этой страны (None - весь трафик)
+
+    Yields:
+        dict: Словарь {domain: TrafficResult} для очередного batch'а
+    """
+    # Записи, для которых не удалось определить цель, сразу помечаем как отсутствующие
+    invalid = {}
+    for domain in domains:
+        try:
+            normalize_target(domain)
+        except ValueError:
+            invalid[domain] = TrafficResult.missing()
+    if invalid:
+        yield invalid
+    
+    batches = iter_sized_batches(domains, batch_size, country)
+    first = next(batches, None)
+    if first is None:
+        return
+    
+    current_date = datetime.now().strftime('%Y-%m-%d')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        in_flight = _submit_batch(executor, first, current_date)
+        while in_flight is not None:
+            submitted = in_flight
+            # Отправляем следующий запрос до разбора текущего ответа
+            next_batch = next(batches, None)
+            in_flight = _submit_batch(executor, next_batch, current_date) if next_batch is not None else None
+            target_results = _collect_batch(submitted, current_date)
+            yield {entry: target_results[target]
+                   for target, entries in submitted[0].entries.items()
+                   for entry in entries}
+
+def get_batch_organic_traffic(domains_batch, batch_size=None, country=None):
+    """
+    ОПТИМИЗИРОВАННЫЙ BATCH ЗАПРОС: Использует правильный /batch-analysis endpoint.
+    Получает трафик для нескольких доменов с volume_mode=average. Список любой
+    длины автоматически разбивается на batch'и, размер которых подбирается
+    по задержке, ошибкам и размеру ответов API (не больше MAX_BATCH_SIZE).
+
+    Тем же запросом (за те же units) собираются дополнительные метрики
+    AHREFS_EXTRA_METRICS - они возвращаются в TrafficResult.metrics.
+    
+    Args:
+        domains_batch (list): Список доменов
+        batch_size (int): Фиксированный размер batch'а (None - подбирается автоматически)
+        country (str): Двухбуквенный код страны - трафик только из этой страны (None - весь трафик)
+        
+    Returns:
+        dict: Словарь {domain: TrafficResult}. Домены, для которых значение
+              не получено, помечаются как MISSING или LIMIT_REACHED, а не нулем
+    """
+    results = {}
+    for batch_results in iter_batch_organic_traffic(domains_batch, batch_size, country):
+        results.update(batch_results)
+    return results
+
 # Оставляем старую функцию для совместимости, но делаем ее оптимизированной
 def get_organic_traffic(domain):
     """
@@ -363,46 +1706,140 @@ def get_organic_traffic(domain):
     """
     return get_current_organic_traffic(domain)
 
-def check_api_availability():
+class ApiHealth(namedtuple('ApiHealth', ['available', 'remaining_units'])):
     """
-    Проверяет доступность API Ahrefs используя оптимизированный endpoint.
+    Результат проверки API: доступен ли API и остаток API units на всех ключах
+    (None, если остаток неизвестен). В условиях ведет себя как available.
     """
-    try:
-        logger.info("Початок перевірки доступності API Ahrefs")
-        if not AHREFS_API_KEY:
-            logger.error("AHREFS_API_KEY не знайдений в змінних середовища (в функції check_api_availability)")
-            return False
-            
-        logger.info(f"Використовуємо ключ AHREFS_API_KEY (перші 4 символи: {AHREFS_API_KEY[:4]}, довжина: {len(AHREFS_API_KEY)})")
-        
-        conn = http.client.HTTPSConnection("api.ahrefs.com")
-        
-        headers = {
-            'Accept': "application/json",
-            'Authorization': f"Bearer {AHREFS_API_KEY}"
-        }
-        
-        # ОПТИМИЗАЦИЯ: используем metrics endpoint для проверки API
-        current_date = datetime.now().strftime('%Y-%m-%d')
-        endpoint = f"/v3/site-explorer/metrics?target=ahrefs.com&mode=domain&volume_mode=average&date={current_date}"
-        
-        conn.request("GET", endpoint, headers=headers)
-        response = conn.getresponse()
-        response_text = response.read().decode('utf-8')
-        
-        # Проверяем на лимит API (403)
-        if _set_api_limit_reached(response.status, response_text):
-            return False
-        
-        if response.status == 200:
-            logger.info("API Ahrefs доступний")
-            return True
+    __slots__ = ()
+
+    def __bool__(self):
+        return bool(self.available)
+
+# Результат последней проверки API и время ее выполнения (time.monotonic)
+_health = None
+_health_checked_at = 0.0
+_health_lock = threading.Lock()
+
+def _fetch_key_units(key):
+    """
+    Запрашивает лимиты одного ключа в subscription-info (запрос не расходует units).
+
+    Returns:
+        tuple: (ответил ли API на ключ, остаток units - меньший из лимитов workspace
+               и ключа - или None, если лимиты не заданы)
+    """
+    response = _ahrefs_request("GET", "/v3/subscription-info/limits-and-usage", api_key=key)
+    if response.status != 200:
+        logger.error(f"Не вдалося отримати залишок API units для ключа {key.fingerprint} "
+                     f"({response.status}): {_truncate(response.text)}")
+        return False, None
+
+    usage = json.loads(response.text).get("limits_and_usage", {})
+    remaining = []
+    for limit_key, usage_key in (("units_limit_workspace", "units_usage_workspace"),
+                                 ("units_limit_api_key", "units_usage_api_key")):
+        # Лимит null означает, что ограничение на этом уровне не задано
+        if usage.get(limit_key) is not None:
+            remaining.append(int(usage[limit_key]) - int(usage.get(usage_key) or 0))
+
+    if not remaining:
+        logger.warning(f"Відповідь subscription-info не містить лімітів: {_truncate(response.text)}")
+        return True, None
+    return True, max(0, min(remaining))
+
+def _probe_api_health():
+    """
+    Опрашивает subscription-info для каждого ключа пула и обновляет бюджеты ключей.
+
+    Ключ с нулевым остатком units отключается так же, как после 403 об исчерпанном
+    лимите: состояние сохраняется, и следующие запуски до 24 числа пропускаются
+    (should_skip_execution_due_to_limit), а не считают API недоступным.
+    """
+    logger.info(f"Перевірка API Ahrefs через subscription-info для {len(_key_pool.keys)} ключ(ів): "
+                f"{', '.join(key.fingerprint for key in _key_pool.keys)}")
+    available = False
+    for key in _key_pool.keys:
+        try:
+            answered, units = _fetch_key_units(key)
+        except Exception as e:
+            logger.error(f"Помилка при отриманні залишку API units для ключа {key.fingerprint}: {str(e)}")
+            continue
+        if not answered:
+            continue
+        _key_pool.set_budget(key, units)
+        if units is None:
+            available = True
         else:
-            logger.error(f"API Ahrefs недоступний. Код відповіді: {response.status} - {response_text}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Помилка при перевірці доступності API Ahrefs: {str(e)}")
-        return False
-    finally:
-        conn.close() 
\ No newline at end of file
+            available = available or units > 0
+            logger.info(f"Залишок API units для ключа {key.fingerprint}: {units}")
+            if units <= 0:
+                _key_pool.trip(key)
+    if _key_pool.all_tripped:
+        _set_api_limit_reached(403, "API units limit reached on all API keys")
+    return ApiHealth(available, _key_pool.total_budget())
+
+def check_api_health(refresh=False):
+    """
+    Проверяет API Ahrefs бесплатным запросом subscription-info (units не расходуются).
+
+    Результат запоминается на AHREFS_HEALTH_TTL секунд, поэтому повторные проверки
+    в рамках запуска не отправляют запросов. Остаток units при этом актуален:
+    он пересчитывается по бюджетам ключей, с которых списываются потраченные units.
+
+    Args:
+        refresh (bool): Выполнить проверку заново, не используя сохраненный результат
+
+    Returns:
+        ApiHealth: Доступность API и остаток API units на всех ключах
+    """
+    global _health, _health_checked_at
+    # Лимит уже достигнут (в том числе в предыдущем запуске) - запрос не отправляем
+    if _api_limit_reached:
+        logger.warning("⚠️ Пропускаємо перевірку доступності API - ліміт API вже досягнуто")
+        return ApiHealth(False, 0)
+    if not AHREFS_API_KEYS:
+        logger.error("AHREFS_API_KEY не знайдений в змінних середовища")
+        return ApiHealth(False, None)
+
+    with _health_lock:
+        if refresh or _health is None or time.monotonic() - _health_checked_at > AHREFS_HEALTH_TTL:
+            _health = _probe_api_health()
+            _health_checked_at = time.monotonic()
+            if _health.available:
+                logger.info(f"API Ahrefs доступний, залишок API units: {_health.remaining_units}")
+            else:
+                logger.error("API Ahrefs недоступний або API units вичерпано")
+            return _health
+        remaining = _key_pool.total_budget()
+        return ApiHealth(_health.available and (remaining is None or remaining > 0), remaining)
+
+def check_api_availability():
+    """
+    Проверяет доступность API Ahrefs (см. check_api_health).
+
+    Returns:
+        ApiHealth: В условиях True, если API доступен и units не исчерпаны;
+                   remaining_units - остаток API units
+    """
+    return check_api_health()
+
+def get_remaining_api_units(refresh=False):
+    """
+    Получает остаток API units из endpoint'а subscription-info (запрос не расходует units).
+
+    Для каждого ключа пула учитываются и лимит workspace, и лимит самого ключа -
+    берется меньший остаток; он же становится бюджетом ключа в пуле. Остатки
+    ключей суммируются: предполагается, что ключи принадлежат разным подпискам.
+    Используется результат check_api_health, поэтому отдельного запроса нет.
+
+    Args:
+        refresh (bool): Запросить остаток заново
+
+    Returns:
+        int: Остаток API units или None, если его не удалось получить ни для одного ключа
+    """
+    remaining = check_api_health(refresh).remaining_units
+    if remaining is not None and len(_key_pool.keys) > 1:
+        logger.info(f"Залишок API units на всіх ключах: {remaining}")
+    return remaining
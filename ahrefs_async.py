@@ -0,0 +1,246 @@
+"""
+Асинхронный клиент Ahrefs API.
+
+Отправляет batch-analysis запросы параллельно, ограничивая количество
+одновременных запросов. Сами запросы выполняются в потоках через общий пул
+соединений ahrefs_api, поэтому время сбора данных определяется самым
+медленным batch'ем, а не суммой всех.
+"""
+import asyncio
+import itertools
+import logging
+
+from ahrefs_api import (
+    TrafficResult, fetch_traffic_history, get_batch_organic_traffic, get_remaining_api_units,
+    is_api_limit_reached, iter_sized_batches
+)
+from ahrefs_targets import normalize_target
+from config import AHREFS_API_KEYS, AHREFS_MAX_IN_FLIGHT
+from fetch_planner import plan_budget
+from run_deadline import fetch_time_left
+
+logger = logging.getLogger(__name__)
+
+def _out_of_time():
+    """Истекло ли время на сбор данных до дедлайна запуска (см. run_deadline)"""
+    time_left = fetch_time_left()
+    return time_left is not None and time_left <= 0
+
+# Каждый ключ пула может вести свои batch'и, поэтому параллельность растет с числом ключей
+DEFAULT_MAX_IN_FLIGHT = AHREFS_MAX_IN_FLIGHT * max(1, len(AHREFS_API_KEYS))
+
+class AsyncAhrefsClient:
+    """
+    Асинхронный клиент для параллельного получения трафика доменов.
+
+    Args:
+        max_in_flight (int): Максимум одновременных batch запросов
+        batch_size (int): Количество доменов в одном batch запросе
+                          (None - размер подбирается по ответам API, см. AdaptiveBatchSizer)
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, batch_size=None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.batch_size = batch_size
+
+    async def _fetch_batches(self, batches, numbers, results):
+        # results - словарь {страна: {domain: TrafficResult}}, страна None - весь трафик
+        # Следующий batch берется только когда освободилось место: его размер
+        # учитывает ответы на уже завершенные запросы
+        for batch in batches:
+            number = next(numbers)
+            entries = [entry for entries in batch.entries.values() for entry in entries]
+            # Если лимит API достигнут другим batch'ем, новые запросы не отправляем
+            if is_api_limit_reached():
+                logger.warning(f"Batch {number} пропущено - ліміт API вже досягнуто")
+                continue
+            # Batch'и идут в порядке приоритета: при нехватке времени пропускаются наименее важные
+            if _out_of_time():
+                logger.warning(f"⏱ Batch {number} пропущено - час на збір даних вичерпано")
+                continue
+
+            logger.info(f"Обробляємо batch {number}: {len(batch.targets)} цілей"
+                        f"{' (' + batch.country.upper() + ')' if batch.country else ''}")
+            batch_results = await asyncio.to_thread(get_batch_organic_traffic, entries, len(batch.targets),
+                                                    batch.country)
+            logger.info(f"Batch {number} завершено: {len(batch_results)} доменів оброблено")
+            results[batch.country].update(batch_results)
+
+    async def fetch_traffic(self, domains):
+        """
+        Получает трафик для всех доменов параллельными batch запросами.
+
+        Args:
+            domains (list): Список доменов (любое количество)
+
+        Returns:
+            dict: Словарь {domain: TrafficResult}
+        """
+        # Batch'и однородны по режиму Ahrefs, поэтому каждый уходит одним запросом.
+        # Генератор общий для всех обработчиков и читается только в потоке event loop
+        batches = iter_sized_batches(domains, self.batch_size)
+
+        logger.info(f"Паралельний збір даних: {len(domains)} доменів, "
+                    f"до {self.max_in_flight} запитів одночасно")
+
+        results = {None: {}}
+        numbers = itertools.count(1)
+        await asyncio.gather(*(
+            self._fetch_batches(batches, numbers, results) for _ in range(self.max_in_flight)
+        ))
+        return results[None]
+
+    async def fetch_country_traffic(self, domains, countries):
+        """
+        Получает трафик доменов по странам параллельными batch запросами.
+
+        Batch-analysis принимает одну страну на запрос, поэтому batch'и
+        формируются для каждой пары (режим, страна) и заполняются полностью.
+        Batch'и всех стран идут через общий набор обработчиков, то есть
+        выполняются одновременно в пределах max_in_flight.
+
+        Args:
+            domains (list): Список доменов (в порядке приоритета)
+            countries (list): Двухбуквенные коды стран
+
+        Returns:
+            dict: Словарь {страна: {domain: TrafficResult}}, в котором для каждой
+                  страны есть каждый домен: значение или явная отметка MISSING / LIMIT_REACHED
+        """
+        batches = itertools.chain.from_iterable(
+            iter_sized_batches(domains, self.batch_size, country) for country in countries
+        )
+
+        logger.info(f"Паралельний збір трафіку за країнами ({', '.join(c.upper() for c in countries)}): "
+                    f"{len(domains)} доменів, до {self.max_in_flight} запитів одночасно")
+
+        results = {country: {} for country in countries}
+        numbers = itertools.count(1)
+        await asyncio.gather(*(
+            self._fetch_batches(batches, numbers, results) for _ in range(self.max_in_flight)
+        ))
+
+        for country_results in results.values():
+            for domain in domains:
+                if domain not in country_results:
+                    country_results[domain] = (TrafficResult.limit_reached() if is_api_limit_reached()
+                                               else TrafficResult.missing())
+        return results
+
+    async def reconcile_traffic(self, domains, results):
+        """
+        Повторно запрашивает только домены, для которых основной проход не дал
+        значения (batch ответ без цели, прерванный fallback, ошибка запроса).
+        Домены заново собираются в полные batch'и и запрашиваются в рамках
+        остатка API units и времени до дедлайна.
+
+        Args:
+            domains (list): Домены основного прохода (в порядке приоритета)
+            results (dict): Результаты основного прохода {domain: TrafficResult}
+
+        Returns:
+            dict: Словарь {domain: TrafficResult}, в котором есть каждый домен из domains:
+                  значение или явная отметка MISSING / LIMIT_REACHED
+        """
+        results = dict(results)
+        retry = []
+        for domain in domains:
+            result = results.get(domain)
+            if result is not None and result.status != TrafficResult.MISSING:
+                continue
+            try:
+                normalize_target(domain)
+            except ValueError:
+                # Запись без хоста повтор не исправит
+                continue
+            retry.append(domain)
+
+        if retry and (is_api_limit_reached() or _out_of_time()):
+            logger.warning(f"Повторний запит для {len(retry)} доменів без значення пропущено - "
+                           f"{'ліміт API досягнуто' if is_api_limit_reached() else 'час на збір даних вичерпано'}")
+        elif retry:
+            # Остаток берется из результата проверки API, отдельного запроса нет
+            plan = plan_budget(retry, get_remaining_api_units())
+            logger.info(f"🔁 Повторний запит для {len(plan.domains)} з {len(retry)} доменів без значення")
+            for domain in plan.skipped:
+                results[domain] = TrafficResult.limit_reached()
+            if plan.domains:
+                retried = await self.fetch_traffic(plan.domains)
+                results.update(retried)
+                recovered = sum(1 for domain in plan.domains if domain in retried and retried[domain].is_ok)
+                logger.info(f"🔁 Повторний запит: отримано значення для {recovered} з {len(plan.domains)} доменів")
+
+        # Каждый домен получает либо значение, либо явную отметку об отсутствии
+        for domain in domains:
+            if domain not in results:
+                results[domain] = TrafficResult.limit_reached() if is_api_limit_reached() else TrafficResult.missing()
+        return results
+
+    async def _fetch_history(self, semaphore, domain, date_from, date_to):
+        async with semaphore:
+            if is_api_limit_reached() or _out_of_time():
+                return None
+            return await asyncio.to_thread(fetch_traffic_history, domain, date_from, date_to)
+
+    async def fetch_history(self, domains, date_from, date_to):
+        """
+        Получает недельную историю трафика доменов параллельными запросами metrics-history
+        (один запрос на домен за весь период).
+
+        Args:
+            domains (list): Список доменов
+            date_from (str): Начало периода (YYYY-MM-DD)
+            date_to (str): Конец периода (YYYY-MM-DD)
+
+        Returns:
+            dict: Словарь {domain: {дата: трафик}}; домены, историю которых получить
+                  не удалось (в том числе из-за лимита API), в словарь не попадают
+        """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        logger.info(f"Паралельний запит історії трафіку: {len(domains)} доменів, "
+                    f"до {self.max_in_flight} запитів одночасно")
+
+        histories = await asyncio.gather(*(
+            self._fetch_history(semaphore, domain, date_from, date_to) for domain in domains
+        ))
+        return {domain: history for domain, history in zip(domains, histories) if history is not None}
+
+def fetch_traffic_concurrently(domains, max_in_flight=DEFAULT_MAX_IN_FLIGHT, reconcile=True):
+    """
+    Синхронная обёртка над AsyncAhrefsClient.fetch_traffic для обычного кода.
+
+    Args:
+        domains (list): Список доменов
+        max_in_flight (int): Максимум одновременных batch запросов
+        reconcile (bool): Повторить запрос для доменов без значения (AsyncAhrefsClient.reconcile_traffic)
+
+    Returns:
+        dict: Словарь {domain: TrafficResult}
+    """
+    client = AsyncAhrefsClient(max_in_flight=max_in_flight)
+
+    async def fetch():
+        results = await client.fetch_traffic(domains)
+        if reconcile:
+            results = await client.reconcile_traffic(domains, results)
+        return results
+
+    return asyncio.run(fetch())
+
+def fetch_country_traffic_concurrently(domains, countries, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """
+    Синхронная обёртка над AsyncAhrefsClient.fetch_country_traffic для обычного кода.
+
+    Returns:
+        dict: Словарь {страна: {domain: TrafficResult}}
+    """
+    return asyncio.run(AsyncAhrefsClient(max_in_flight=max_in_flight).fetch_country_traffic(domains, countries))
+
+def fetch_history_concurrently(domains, date_from, date_to, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """
+    Синхронная обёртка над AsyncAhrefsClient.fetch_history для обычного кода.
+
+    Returns:
+        dict: Словарь {domain: {дата: трафик}}
+    """
+    return asyncio.run(AsyncAhrefsClient(max_in_flight=max_in_flight).fetch_history(domains, date_from, date_to))
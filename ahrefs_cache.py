@@ -0,0 +1,135 @@
+"""
+Постоянный кэш ответов API Ahrefs на диске.
+
+Повторный запуск в тот же день (повтор workflow, send_test_message.py,
+test_local.py, демон main.py) берет данные из кэша и не расходует API units.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from config import AHREFS_CACHE_DIR, AHREFS_CACHE_TTL, AHREFS_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+class AhrefsResponseCache:
+    """
+    Кэш ответов API Ahrefs с ограничением по времени жизни и размеру.
+
+    Ключ записи - (target, mode, volume_mode, date, endpoint). Каждая запись
+    хранится в отдельном JSON файле и записывается атомарно (временный файл +
+    os.replace), поэтому прерванный процесс не оставляет поврежденных записей.
+    Когда общий размер кэша превышает max_bytes, удаляются самые старые записи.
+
+    Args:
+        directory (str): Каталог кэша
+        ttl (float): Время жизни записи в секундах (0 - кэш отключен)
+        max_bytes (int): Максимальный общий размер кэша в байтах
+    """
+
+    def __init__(self, directory=AHREFS_CACHE_DIR, ttl=AHREFS_CACHE_TTL, max_bytes=AHREFS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._size = None  # Общий размер кэша, вычисляется при первой записи
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def get(self, target, mode, volume_mode, date, endpoint):
+        """
+        Возвращает сохраненные данные или None, если записи нет или она устарела.
+        """
+        if not self.enabled:
+            return None
+        path = self._path([target, mode, volume_mode, date, endpoint])
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не вдалося прочитати запис кешу {path}: {str(e)}")
+            return None
+
+        if time.time() - entry.get("stored_at", 0) > self.ttl:
+            return None
+        return entry.get("data")
+
+    def set(self, target, mode, volume_mode, date, endpoint, data):
+        """Сохраняет данные для ключа"""
+        if not self.enabled:
+            return
+        key = [target, mode, volume_mode, date, endpoint]
+        payload = json.dumps({"stored_at": time.time(), "key": key, "data": data}).encode("utf-8")
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Не вдалося записати запис кешу {path}: {str(e)}")
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(payload)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """Возвращает [(mtime, size, path)] для всех записей кэша"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Удаляет самые старые записи, пока кэш не уменьшится до 90% от max_bytes"""
+        entries = sorted(self._entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target_size = self.max_bytes * 0.9
+        removed = 0
+        for _, entry_size, path in entries:
+            if size <= target_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+        self._size = size
+        logger.info(f"Кеш Ahrefs: видалено {removed} найстаріших записів, розмір {size} байт")
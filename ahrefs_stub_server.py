@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Локальный заменитель Ahrefs API для офлайн-тестов и нагрузочных прогонов.
+
+Реализует endpoint'ы, которые использует ahrefs_api:
+
+- GET  /v3/site-explorer/metrics
+- POST /v3/site-explorer/batch-analysis
+- GET  /v3/site-explorer/metrics-history
+- GET  /v3/subscription-info/limits-and-usage (бесплатный)
+- GET  /stub/stats - счетчики запросов, units и внедренных ошибок
+
+Данные детерминированы: трафик зависит только от цели, режима и даты.
+Сервер умеет добавлять задержку с заданным распределением, отвечать 429/5xx
+и 403 без отношения к лимиту (нет доступа) с заданной вероятностью и возвращать
+403 после исчерпания лимита units (общего или отдельного для каждого ключа API).
+
+Пример:
+    python ahrefs_stub_server.py --port 8080 --latency uniform:0.05:0.3 --error-429 0.1 --units-limit 5000
+    AHREFS_API_URL=http://127.0.0.1:8080 AHREFS_API_KEY=stub python test_ahrefs_api.py
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = "/v3/site-explorer/metrics"
+BATCH_PATH = "/v3/site-explorer/batch-analysis"
+HISTORY_PATH = "/v3/site-explorer/metrics-history"
+LIMITS_PATH = "/v3/subscription-info/limits-and-usage"
+STATS_PATH = "/stub/stats"
+
+# Стоимость запросов в API units (как в AHREFS_UNITS_PER_TARGET / AHREFS_MIN_UNITS_PER_REQUEST)
+UNITS_PER_ROW = 10
+MIN_UNITS_PER_REQUEST = 50
+
+def parse_latency(spec):
+    """
+    Разбирает описание распределения задержки.
+
+    Форматы: "0" (без задержки), "fixed:S", "uniform:MIN:MAX", "normal:MEAN:SD",
+    "lognormal:MU:SIGMA", "exponential:MEAN". Значения в секундах.
+
+    Returns:
+        callable: Функция (random.Random) -> задержка в секундах
+    """
+    name, _, params = spec.partition(':')
+    try:
+        args = [float(value) for value in params.split(':')] if params else []
+        if name in ('0', 'none'):
+            return lambda rng: 0.0
+        if name == 'fixed':
+            delay, = args
+            return lambda rng: delay
+        if name == 'uniform':
+            low, high = args
+            return lambda rng: rng.uniform(low, high)
+        if name == 'normal':
+            mean, sd = args
+            return lambda rng: max(0.0, rng.gauss(mean, sd))
+        if name == 'lognormal':
+            mu, sigma = args
+            return lambda rng: rng.lognormvariate(mu, sigma)
+        if name == 'exponential':
+            mean, = args
+            return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Некоректний опис затримки: '{spec}'")
+
+def stub_traffic(target, mode, date):
+    """
+    Детерминированный трафик цели на дату: базовое значение из хэша цели и
+    плавное недельное колебание с небольшим шумом.
+    """
+    base = int(hashlib.sha256(f"{mode}:{target}".encode('utf-8')).hexdigest()[:8], 16) % 1_000_000 + 1_000
+    day = datetime.strptime(date[:10], '%Y-%m-%d').toordinal()
+    noise = int(hashlib.sha256(f"{target}:{date[:10]}".encode('utf-8')).hexdigest()[:4], 16) / 0xffff
+    return int(base * (1 + 0.2 * math.sin(day / 7 / 4) + 0.05 * (noise - 0.5)))
+
+def stub_country_share(target, country):
+    """Детерминированная доля трафика цели из страны country (от 5% до 80%)"""
+    return 0.05 + int(hashlib.sha256(f"{country}:{target}".encode('utf-8')).hexdigest()[:4], 16) / 0xffff * 0.75
+
+def stub_metrics(target, mode, date, country=None):
+    """Набор метрик site-explorer для цели на дату (для country - только трафик из этой страны)"""
+    traffic = stub_traffic(target, mode, date)
+    if country:
+        traffic = int(traffic * stub_country_share(target, country))
+    return {
+        "org_traffic": traffic,
+        "org_keywords": traffic // 7,
+        "org_cost": traffic * 3,
+        "domain_rating": round(20 + traffic % 7000 / 100, 1),
+        "refdomains": traffic // 25,
+        "paid_traffic": traffic // 20,
+        "paid_keywords": traffic // 140,
+        "paid_cost": traffic // 2,
+    }
+
+class StubState:
+    """
+    Настройки и счетчики заменителя API (общие для всех потоков сервера).
+
+    Args:
+        latency (callable): Распределение задержки (см. parse_latency)
+        error_429 (float): Вероятность ответа 429
+        error_5xx (float): Вероятность ответа 500/502/503
+        error_403 (float): Вероятность ответа 403, не связанного с лимитом units
+        retry_after (float): Значение заголовка Retry-After для 429
+        units_limit (int): Лимит API units, после которого отвечаем 403 (None - без лимита)
+        seed (int): Seed генератора задержек и ошибок
+        key_units_limit (int): Лимит API units на каждый ключ API (None - без лимита)
+    """
+
+    def __init__(self, latency=None, error_429=0.0, error_5xx=0.0, retry_after=1, units_limit=None, seed=0,
+                 key_units_limit=None, error_403=0.0):
+        self.latency = latency or parse_latency('0')
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.error_403 = error_403
+        self.retry_after = retry_after
+        self.units_limit = units_limit
+        self.key_units_limit = key_units_limit
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.units_used = 0
+        self.units_by_key = {}
+        self.by_endpoint = {}
+        self.injected = {"429": 0, "5xx": 0, "403": 0}
+
+    def draw(self):
+        """Возвращает (задержка, внедряемый статус или None) для очередного запроса"""
+        with self._lock:
+            delay = self.latency(self._rng)
+            roll = self._rng.random()
+        if roll < self.error_429:
+            return delay, 429
+        if roll < self.error_429 + self.error_5xx:
+            return delay, (500, 502, 503)[int(roll * 1000) % 3]
+        if roll < self.error_429 + self.error_5xx + self.error_403:
+            return delay, 403
+        return delay, None
+
+    def count(self, path, status):
+        with self._lock:
+            self.requests += 1
+            self.by_endpoint[path] = self.by_endpoint.get(path, 0) + 1
+            if status == 429:
+                self.injected["429"] += 1
+            elif status >= 500:
+                self.injected["5xx"] += 1
+            elif status == 403:
+                self.injected["403"] += 1
+
+    def charge(self, units, api_key):
+        """Списывает units с общего лимита и лимита ключа; возвращает False, если лимит исчерпан"""
+        with self._lock:
+            key_used = self.units_by_key.get(api_key, 0)
+            if self.units_limit is not None and self.units_used + units > self.units_limit:
+                return False
+            if self.key_units_limit is not None and key_used + units > self.key_units_limit:
+                return False
+            self.units_used += units
+            self.units_by_key[api_key] = key_used + units
+            return True
+
+    def key_usage(self, api_key):
+        with self._lock:
+            return self.units_by_key.get(api_key, 0)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "units_used": self.units_used,
+                "units_limit": self.units_limit,
+                "keys": len(self.units_by_key),
+                "by_endpoint": dict(self.by_endpoint),
+                "injected_errors": dict(self.injected),
+            }
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, как у настоящего API: пул соединений ahrefs_api переиспользует соединения
+    protocol_version = "HTTP/1.1"
+    server_version = "AhrefsStub/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    @property
+    def state(self):
+        return self.server.stub_state
+
+    def _send_json(self, status, payload, units=0, extra_headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        accepted = self.headers.get("Accept-Encoding") or ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in accepted:
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("x-api-units-cost-total-actual", str(units))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент не дождался ответа (таймаут чтения) - для заменителя это штатная ситуация
+            logger.debug(f"Клієнт закрив з'єднання до відповіді на {self.path}")
+        self.state.count(urlsplit(self.path).path, status)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        body = self._read_body()
+
+        if url.path == STATS_PATH:
+            return self._send_json(200, self.state.stats())
+
+        authorization = self.headers.get("Authorization") or ""
+        if not authorization.startswith("Bearer "):
+            return self._send_json(401, {"error": "Authorization required"})
+        api_key = authorization[len("Bearer "):]
+
+        if url.path == LIMITS_PATH and method == "GET":
+            # Запрос информации о подписке бесплатный и не подвержен внедряемым ошибкам
+            stats = self.state.stats()
+            return self._send_json(200, {"limits_and_usage": {
+                "units_limit_workspace": stats["units_limit"],
+                "units_usage_workspace": stats["units_used"],
+                "units_limit_api_key": self.state.key_units_limit,
+                "units_usage_api_key": self.state.key_usage(api_key),
+            }})
+
+        routes = {
+            ("GET", METRICS_PATH): self._metrics,
+            ("POST", BATCH_PATH): self._batch_analysis,
+            ("GET", HISTORY_PATH): self._metrics_history,
+        }
+        handler = routes.get((method, url.path))
+        if handler is None:
+            return self._send_json(404, {"error": f"Unknown endpoint {method} {url.path}"})
+
+        delay, injected_status = self.state.draw()
+        if delay:
+            time.sleep(delay)
+        if injected_status == 429:
+            return self._send_json(429, {"error": "Rate limit exceeded"},
+                                   extra_headers={"Retry-After": str(self.state.retry_after)})
+        if injected_status == 403:
+            return self._send_json(403, {"error": "Access to this target is denied"})
+        if injected_status is not None:
+            return self._send_json(injected_status, {"error": "Injected server error"})
+
+        try:
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            payload = json.loads(body) if body else {}
+            status, response, units = handler(params, payload)
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send_json(400, {"error": f"Bad request: {e}"})
+
+        if status == 200 and not self.state.charge(units, api_key):
+            return self._send_json(403, {"error": "API units limit reached"})
+        return self._send_json(status, response, units=units if status == 200 else 0)
+
+    def _metrics(self, params, payload):
+        date = params.get("date") or datetime.now().strftime('%Y-%m-%d')
+        metrics = stub_metrics(params["target"], params.get("mode", "domain"), date, params.get("country"))
+        return 200, {"metrics": metrics}, MIN_UNITS_PER_REQUEST
+
+    def _batch_analysis(self, params, payload):
+        targets = payload["targets"]
+        mode = payload.get("mode", "domain")
+        date = payload.get("date") or datetime.now().strftime('%Y-%m-%d')
+        select = payload.get("select")
+        country = payload.get("country")
+        rows = [dict(index=index, url=target, mode=mode, **stub_metrics(target, mode, date, country))
+                for index, target in enumerate(targets)]
+        if select:
+            # Как настоящий API, возвращаем только запрошенные поля
+            rows = [{field: row[field] for field in select if field in row} for row in rows]
+        return 200, {"targets": rows}, max(MIN_UNITS_PER_REQUEST, UNITS_PER_ROW * len(rows))
+
+    def _metrics_history(self, params, payload):
+        date_from = datetime.strptime(params["date_from"], '%Y-%m-%d')
+        date_to = datetime.strptime(params.get("date_to") or datetime.now().strftime('%Y-%m-%d'), '%Y-%m-%d')
+        mode = params.get("mode", "domain")
+        # Недельные точки - по понедельникам
+        point = date_from - timedelta(days=date_from.weekday())
+        rows = []
+        while point <= date_to:
+            date = point.strftime('%Y-%m-%d')
+            rows.append({"date": f"{date}T00:00:00Z", "org_traffic": stub_traffic(params["target"], mode, date)})
+            point += timedelta(days=7)
+        return 200, {"metrics": rows}, max(MIN_UNITS_PER_REQUEST, UNITS_PER_ROW * len(rows))
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+def start_stub_server(host="127.0.0.1", port=0, **state_options):
+    """
+    Запускает заменитель API в фоновом потоке (для нагрузочных прогонов из Python).
+
+    Args:
+        host (str): Адрес для прослушивания
+        port (int): Порт (0 - любой свободный)
+        **state_options: Параметры StubState
+
+    Returns:
+        ThreadingHTTPServer: Сервер; адрес - server.server_address, счетчики - server.stub_state,
+                             остановка - server.shutdown()
+    """
+    server = ThreadingHTTPServer((host, port), StubRequestHandler)
+    server.daemon_threads = True
+    server.stub_state = StubState(**state_options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description="Локальний замінник Ahrefs API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency('0'),
+                        help="Розподіл затримки: fixed:S, uniform:MIN:MAX, normal:MEAN:SD, "
+                             "lognormal:MU:SIGMA, exponential:MEAN")
+    parser.add_argument("--error-429", type=float, default=0.0, help="Ймовірність відповіді 429")
+    parser.add_argument("--error-5xx", type=float, default=0.0, help="Ймовірність відповіді 500/502/503")
+    parser.add_argument("--error-403", type=float, default=0.0,
+                        help="Ймовірність відповіді 403, не пов'язаної з лімітом units")
+    parser.add_argument("--retry-after", type=float, default=1, help="Retry-After для 429, секунди")
+    parser.add_argument("--units-limit", type=int, default=None,
+                        help="Ліміт API units, після якого сервер відповідає 403")
+    parser.add_argument("--key-units-limit", type=int, default=None,
+                        help="Ліміт API units на кожен ключ API (перевірка пулу ключів)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed для затримок і помилок")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StubRequestHandler)
+    server.daemon_threads = True
+    server.stub_state = StubState(args.latency, args.error_429, args.error_5xx,
+                                  args.retry_after, args.units_limit, args.seed, args.key_units_limit,
+                                  args.error_403)
+    logger.info(f"Замінник Ahrefs API слухає http://{args.host}:{args.port} "
+                f"(статистика: http://{args.host}:{args.port}{STATS_PATH})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Статистика: {json.dumps(server.stub_state.stats(), ensure_ascii=False)}")
+
+if __name__ == "__main__":
+    main()
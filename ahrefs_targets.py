@@ -0,0 +1,178 @@
+"""
+Нормализация целей (targets) для Ahrefs API.
+
+domains.txt содержит голые домены, хосты с www. и URL с путями. Для каждой
+записи определяется цель и режим Ahrefs:
+
+- ``*.example.com`` - ``subdomains`` (домен со всеми поддоменами)
+- ``example.com``, ``https://www.example.com/`` - ``domain``
+- ``example.com/ua``, ``example.com/ua/uk/`` (раздел сайта) - ``prefix``
+- ``example.com/page.html`` (путь к файлу), URL с query - ``exact``
+
+Режим можно указать явно: ``subdomains:example.com``, ``exact:example.com/ua/``.
+
+До перехода на режимы разделов (AHREFS_PATH_MODES_SINCE) записи с путем
+без явного режима запрашиваются в режиме ``domain``, как раньше, чтобы
+история в таблице оставалась сопоставимой. После перехода значения таких
+записей до этой даты в анализе изменений не используются (см. history_start).
+
+``www.example.com`` и ``example.com`` считаются одной целью.
+
+Цель может относиться к стране (двухбуквенный код, параметр country Ahrefs):
+тогда запрашивается трафик только из этой страны.
+"""
+import logging
+import posixpath
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from config import AHREFS_PATH_MODES_SINCE
+
+logger = logging.getLogger(__name__)
+
+# Режимы Ahrefs API для параметра mode
+TARGET_MODES = ('domain', 'subdomains', 'prefix', 'exact')
+
+# Нормализованная цель запроса: строка target, режим mode и страна (None - весь трафик)
+AhrefsTarget = namedtuple('AhrefsTarget', ['target', 'mode', 'country'], defaults=(None,))
+
+# Однородный batch: режим, уникальные цели, исходные записи для каждой цели и страна
+TargetBatch = namedtuple('TargetBatch', ['mode', 'targets', 'entries', 'country'], defaults=(None,))
+
+def normalize_target(entry):
+    """
+    Определяет цель и режим Ahrefs для записи из списка доменов.
+
+    Args:
+        entry (str | AhrefsTarget): Домен, хост или URL (AhrefsTarget возвращается как есть)
+
+    Returns:
+        AhrefsTarget: Нормализованная цель
+
+    Raises:
+        ValueError: Если в записи нет хоста
+    """
+    if isinstance(entry, AhrefsTarget):
+        return entry
+
+    text = entry.strip()
+    mode = None
+    prefix, separator, rest = text.partition(':')
+    if separator and prefix.lower() in TARGET_MODES and not rest.startswith('//'):
+        mode, text = prefix.lower(), rest.strip()
+
+    parsed = urlsplit(text if '://' in text else '//' + text)
+    host = (parsed.hostname or '').rstrip('.')
+    if host.startswith('*.'):
+        host = host[2:]
+        mode = mode or 'subdomains'
+    if not host:
+        raise ValueError(f"Не вдалося визначити хост у записі '{entry}'")
+
+    path = parsed.path or '/'
+    is_file = '.' in posixpath.basename(path)
+    if parsed.query:
+        path = f"{path}?{parsed.query}"
+
+    if mode is None:
+        if path == '/':
+            mode = 'domain'
+        elif not AHREFS_PATH_MODES_SINCE:
+            # Запись с путем до перехода на режимы разделов - режим domain, как в истории таблицы
+            return AhrefsTarget(host + path, 'domain')
+        elif parsed.query or is_file:
+            mode = 'exact'
+        else:
+            mode = 'prefix'
+
+    if mode in ('domain', 'subdomains'):
+        return AhrefsTarget(host, mode)
+    return AhrefsTarget(host + path, mode)
+
+def _dedup_key(target):
+    """Ключ для поиска одинаковых целей: www.example.com и example.com - одна цель"""
+    name = target.target[4:] if target.target.startswith('www.') else target.target
+    return name, target.mode, target.country
+
+def history_start(entry):
+    """
+    Дата, начиная с которой значения записи в таблице сопоставимы между собой.
+
+    Записи с путем до AHREFS_PATH_MODES_SINCE запрашивались в режиме domain,
+    поэтому более ранние значения относятся ко всему домену, а не к разделу.
+
+    Args:
+        entry (str): Запись из списка доменов
+
+    Returns:
+        str: Дата (YYYY-MM-DD) или None, если сопоставима вся история
+    """
+    if not AHREFS_PATH_MODES_SINCE:
+        return None
+    try:
+        target = normalize_target(entry)
+    except ValueError:
+        return None
+    return AHREFS_PATH_MODES_SINCE if target.mode in ('prefix', 'exact') else None
+
+def unique_targets(entries):
+    """
+    Убирает записи, которые указывают на ту же цель, что и предыдущие.
+
+    Args:
+        entries (list): Записи из списка доменов
+
+    Returns:
+        list: Записи без дублей (первая запись для каждой цели, порядок сохраняется).
+              Записи, которые не удалось нормализовать, остаются как есть
+    """
+    seen = {}
+    unique = []
+    for entry in entries:
+        try:
+            target = normalize_target(entry)
+        except ValueError:
+            unique.append(entry)
+            continue
+        key = _dedup_key(target)
+        if key in seen:
+            logger.warning(f"Дублікат '{entry}' (ціль {target.target}, режим {target.mode}) - вже є як '{seen[key]}'")
+            continue
+        seen[key] = entry
+        unique.append(entry)
+    return unique
+
+def batch_targets(entries, batch_size, country=None):
+    """
+    Группирует записи по режиму Ahrefs и разбивает на однородные batch'и.
+
+    Записи с одинаковой целью запрашиваются один раз. Все batch'и, кроме
+    последнего в каждом режиме, заполнены полностью.
+
+    Args:
+        entries (list): Записи из списка доменов
+        batch_size (int): Максимум уникальных целей в одном batch'е
+        country (str): Страна, для которой запрашивается трафик (None - весь трафик)
+
+    Returns:
+        list: Список TargetBatch. Записи, которые не удалось нормализовать, пропускаются
+    """
+    entries_by_target = {}
+    canonical = {}
+    for entry in entries:
+        try:
+            target = normalize_target(entry)._replace(country=country)
+        except ValueError as e:
+            logger.warning(str(e))
+            continue
+        # Эквивалентные записи (www. и без него) запрашиваются по первой из них
+        target = canonical.setdefault(_dedup_key(target), target)
+        entries_by_target.setdefault(target, []).append(entry)
+
+    batches = []
+    for mode in TARGET_MODES:
+        targets = [target for target in entries_by_target if target.mode == mode]
+        for start in range(0, len(targets), batch_size):
+            chunk = targets[start:start + batch_size]
+            batches.append(TargetBatch(mode, chunk, {target: entries_by_target[target] for target in chunk}, country))
+    return batches
@@ -7,7 +7,89 @@ load_dotenv()
 
 # Ahrefs API
 AHREFS_API_KEY = os.getenv('AHREFS_API_KEY')
-AHREFS_API_URL = 'https://api.ahrefs.com'  # Базовый URL без версии API
+# Пул ключей API через запятую; если не задан, используется AHREFS_API_KEY
+AHREFS_API_KEYS = [key.strip() for key in os.getenv('AHREFS_API_KEYS', '').split(',') if key.strip()] \
+    or ([AHREFS_API_KEY] if AHREFS_API_KEY else [])
+AHREFS_KEY_MAX_CONCURRENCY = int(os.getenv('AHREFS_KEY_MAX_CONCURRENCY', '4'))  # Одновременных запросов на один ключ
+AHREFS_API_URL = os.getenv('AHREFS_API_URL', 'https://api.ahrefs.com')  # Базовый URL без версии API (http://127.0.0.1:8080 - ahrefs_stub_server)
+
+# Пул постоянных HTTPS-соединений к API Ahrefs
+AHREFS_POOL_SIZE = int(os.getenv('AHREFS_POOL_SIZE', '8'))  # Максимум простаивающих соединений в пуле
+AHREFS_POOL_IDLE_TIMEOUT = float(os.getenv('AHREFS_POOL_IDLE_TIMEOUT', '30'))  # Через сколько секунд простоя соединение закрывается
+AHREFS_MAX_RESPONSE_BYTES = int(os.getenv('AHREFS_MAX_RESPONSE_BYTES', str(20 * 1024 * 1024)))  # Максимальный размер ответа после распаковки
+
+# Таймауты сетевых вызовов (секунды) и дедлайн запуска
+AHREFS_CONNECT_TIMEOUT = float(os.getenv('AHREFS_CONNECT_TIMEOUT', '10'))  # Установка соединения с API Ahrefs
+AHREFS_READ_TIMEOUT = float(os.getenv('AHREFS_READ_TIMEOUT', '60'))  # Ожидание данных от API Ahrefs
+SHEETS_TIMEOUT = float(os.getenv('SHEETS_TIMEOUT', '60'))  # Запросы к Google Sheets API
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', '10'))  # Установка соединения с Telegram
+TELEGRAM_READ_TIMEOUT = float(os.getenv('TELEGRAM_READ_TIMEOUT', '20'))  # Ожидание ответа Telegram
+RUN_DEADLINE_SECONDS = float(os.getenv('RUN_DEADLINE_SECONDS', '1500'))  # Длительность запуска (0 - без дедлайна)
+RUN_DEADLINE_RESERVE = float(os.getenv('RUN_DEADLINE_RESERVE', '180'))  # Время, оставляемое на запись и уведомления
+
+# Размер batch-analysis запросов подстраивается под задержку и ошибки API
+AHREFS_BATCH_SIZE = int(os.getenv('AHREFS_BATCH_SIZE', '50'))  # Начальный размер batch'а
+AHREFS_MIN_BATCH_SIZE = int(os.getenv('AHREFS_MIN_BATCH_SIZE', '5'))  # Меньше не уменьшаем - дальше индивидуальные запросы
+AHREFS_MAX_BATCH_SIZE = int(os.getenv('AHREFS_MAX_BATCH_SIZE', '100'))  # Максимум целей в одном запросе у Ahrefs
+AHREFS_BATCH_TARGET_LATENCY = float(os.getenv('AHREFS_BATCH_TARGET_LATENCY', '15'))  # Желаемое время batch запроса в секундах
+
+# Параллельные batch-analysis запросы
+AHREFS_MAX_IN_FLIGHT = int(os.getenv('AHREFS_MAX_IN_FLIGHT', '4'))  # Максимум одновременных batch запросов
+AHREFS_FALLBACK_WORKERS = int(os.getenv('AHREFS_FALLBACK_WORKERS', '5'))  # Потоков для индивидуальных запросов при сбое batch запроса
+
+# Ограничение частоты запросов к API Ahrefs
+AHREFS_RATE_LIMIT_RPM = float(os.getenv('AHREFS_RATE_LIMIT_RPM', '60'))  # Запросов в минуту
+AHREFS_RATE_LIMIT_BURST = int(os.getenv('AHREFS_RATE_LIMIT_BURST', '10'))  # Сколько запросов можно отправить подряд без паузы
+AHREFS_MAX_CONCURRENCY = int(os.getenv('AHREFS_MAX_CONCURRENCY', '8'))  # Верхняя граница одновременных запросов
+AHREFS_MAX_THROTTLE_RETRIES = int(os.getenv('AHREFS_MAX_THROTTLE_RETRIES', '5'))  # Сколько раз повторять запрос после 429
+AHREFS_MAX_RETRY_AFTER = float(os.getenv('AHREFS_MAX_RETRY_AFTER', '120'))  # Максимальная пауза по Retry-After в секундах
+
+# Повторы при временных ошибках API Ahrefs (5xx, 408, сетевые ошибки)
+AHREFS_MAX_RETRIES = int(os.getenv('AHREFS_MAX_RETRIES', '3'))  # Сколько раз повторять запрос
+AHREFS_RETRY_BASE_DELAY = float(os.getenv('AHREFS_RETRY_BASE_DELAY', '1'))  # Задержка перед первым повтором в секундах
+AHREFS_RETRY_MAX_DELAY = float(os.getenv('AHREFS_RETRY_MAX_DELAY', '30'))  # Максимальная задержка между повторами в секундах
+
+# Дополнительные метрики batch-analysis, которые сохраняются рядом с org_traffic (каждая на своем листе)
+AHREFS_EXTRA_METRICS = [field.strip() for field in
+                        os.getenv('AHREFS_EXTRA_METRICS', 'org_keywords,domain_rating,refdomains,org_cost').split(',')
+                        if field.strip()]
+
+# Страны (двухбуквенные коды через запятую), для которых дополнительно собирается органический трафик
+# (каждая на своем листе Traffic_<КОД>). Пустое значение - только общий трафик
+AHREFS_COUNTRIES = [country.strip().lower() for country in os.getenv('AHREFS_COUNTRIES', '').split(',')
+                    if country.strip()]
+
+# Дата перехода на режимы разделов (YYYY-MM-DD): с нее записи с путем (example.com/ua) запрашиваются
+# в режиме prefix/exact, а более ранние значения таких записей не сравниваются с новыми.
+# Пустое значение - записи с путем запрашиваются в режиме domain, как до нормализации целей
+AHREFS_PATH_MODES_SINCE = os.getenv('AHREFS_PATH_MODES_SINCE', '').strip()
+
+# Планирование расхода API units
+AHREFS_UNITS_PER_TARGET = int(os.getenv('AHREFS_UNITS_PER_TARGET', '10'))  # Оценка стоимости одного домена в batch запросе
+AHREFS_MIN_UNITS_PER_REQUEST = int(os.getenv('AHREFS_MIN_UNITS_PER_REQUEST', '50'))  # Минимальная стоимость одного запроса
+AHREFS_UNITS_RESERVE = int(os.getenv('AHREFS_UNITS_RESERVE', '0'))  # Сколько units оставлять неизрасходованными
+PRIORITY_DOMAINS_FILE = 'priority_domains.txt'  # Домены, которые собираются в первую очередь (необязательный файл)
+
+# Окна свежести: значение домена не запрашивается повторно, пока ему меньше N дней
+AHREFS_FRESHNESS_DAYS = int(os.getenv('AHREFS_FRESHNESS_DAYS', '1'))  # 1 - запрашивать, если нет значения за сегодня
+FRESHNESS_WINDOWS_FILE = 'freshness_windows.txt'  # Окна для отдельных доменов: строки "домен дни" (необязательный файл)
+
+# Кэш ответов API Ahrefs на диске
+AHREFS_CACHE_DIR = os.getenv('AHREFS_CACHE_DIR', '.ahrefs_cache')
+AHREFS_CACHE_TTL = float(os.getenv('AHREFS_CACHE_TTL', '86400'))  # Время жизни записи в секундах (0 - кэш отключен)
+AHREFS_CACHE_MAX_BYTES = int(os.getenv('AHREFS_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))  # Максимальный размер кэша
+
+# Логирование запросов к API Ahrefs
+AHREFS_LOG_LEVEL = os.getenv('AHREFS_LOG_LEVEL', 'INFO').upper()  # DEBUG включает выборочную запись тел ответов
+AHREFS_LOG_STRUCTURED = os.getenv('AHREFS_LOG_STRUCTURED', 'false').lower() in ('1', 'true', 'yes')  # События запросов в JSON
+AHREFS_LOG_BODY_SAMPLE_RATE = float(os.getenv('AHREFS_LOG_BODY_SAMPLE_RATE', '0.1'))  # Доля ответов, тело которых пишется в DEBUG
+AHREFS_LOG_BODY_MAX_CHARS = int(os.getenv('AHREFS_LOG_BODY_MAX_CHARS', '500'))  # Сколько символов тела писать в лог
+
+# Проверка API через subscription-info (бесплатно): результат используется повторно в течение N секунд
+AHREFS_HEALTH_TTL = float(os.getenv('AHREFS_HEALTH_TTL', '900'))
+
+# Файл с состоянием лимита API: сохраняет достигнутый лимит между запусками до 24 числа
+AHREFS_LIMIT_STATE_FILE = os.getenv('AHREFS_LIMIT_STATE_FILE', 'api_limit_state.json')
 
 # Telegram Bot
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -0,0 +1,276 @@
+"""
+Планирование сбора данных Ahrefs в рамках доступного бюджета API units.
+"""
+import logging
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from ahrefs_api import BATCH_SIZE
+from ahrefs_targets import batch_targets
+from config import (
+    AHREFS_UNITS_PER_TARGET, AHREFS_MIN_UNITS_PER_REQUEST, AHREFS_UNITS_RESERVE,
+    PRIORITY_DOMAINS_FILE, AHREFS_FRESHNESS_DAYS, FRESHNESS_WINDOWS_FILE
+)
+
+logger = logging.getLogger(__name__)
+
+# План сбора: домены для запроса (в порядке приоритета), пропущенные домены и оценка стоимости
+BudgetPlan = namedtuple('BudgetPlan', ['domains', 'skipped', 'estimated_units'])
+
+# Последнее успешно полученное значение домена: дата данных и трафик
+LastFetch = namedtuple('LastFetch', ['date', 'value'])
+
+# План по свежести: устаревшие домены для запроса и свежие домены с сохраненными значениями
+FreshnessPlan = namedtuple('FreshnessPlan', ['stale', 'fresh'])
+
+def estimate_units(domain_count, batch_size=BATCH_SIZE):
+    """
+    Оценивает стоимость получения трафика для domain_count доменов batch запросами.
+
+    Каждый batch стоит AHREFS_UNITS_PER_TARGET за домен, но не меньше
+    AHREFS_MIN_UNITS_PER_REQUEST за запрос.
+
+    Args:
+        domain_count (int): Количество доменов
+        batch_size (int): Количество доменов в одном batch запросе
+
+    Returns:
+        int: Оценка расхода API units
+    """
+    units = 0
+    for start in range(0, domain_count, batch_size):
+        targets = min(batch_size, domain_count - start)
+        units += max(AHREFS_MIN_UNITS_PER_REQUEST, targets * AHREFS_UNITS_PER_TARGET)
+    return units
+
+def estimate_targets_units(domains, batch_size=BATCH_SIZE):
+    """
+    Оценивает стоимость запроса списка доменов с учетом того, что дубли
+    запрашиваются один раз, а batch'и группируются по режиму Ahrefs.
+
+    Args:
+        domains (list): Список доменов и URL
+        batch_size (int): Количество целей в одном batch запросе
+
+    Returns:
+        int: Оценка расхода API units
+    """
+    return sum(estimate_units(len(batch.targets), batch_size) for batch in batch_targets(domains, batch_size))
+
+def estimate_history_units(domains):
+    """
+    Оценивает стоимость запросов metrics-history: один запрос на домен.
+
+    Returns:
+        int: Оценка расхода API units
+    """
+    return len(domains) * max(AHREFS_MIN_UNITS_PER_REQUEST, AHREFS_UNITS_PER_TARGET)
+
+def load_priority_domains(path=PRIORITY_DOMAINS_FILE):
+    """
+    Загружает список приоритетных доменов (по одному на строку).
+
+    Returns:
+        list: Приоритетные домены или пустой список, если файла нет
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def prioritize_domains(domains, weights=None, priority_domains=None):
+    """
+    Упорядочивает домены по важности.
+
+    Сначала идут домены из priority_domains (в их порядке), затем остальные
+    по убыванию веса (например, последнего известного трафика). При равном
+    весе сохраняется исходный порядок.
+
+    Args:
+        domains (list): Список доменов
+        weights (dict): Словарь {domain: вес}
+        priority_domains (list): Домены, которые всегда идут первыми
+
+    Returns:
+        list: Домены в порядке приоритета
+    """
+    weights = weights or {}
+    priority_rank = {domain: rank for rank, domain in enumerate(priority_domains or [])}
+
+    def sort_key(item):
+        position, domain = item
+        if domain in priority_rank:
+            return (0, priority_rank[domain], 0)
+        return (1, -weights.get(domain, 0), position)
+
+    return [domain for _, domain in sorted(enumerate(domains), key=sort_key)]
+
+def plan_budget(domains, remaining_units, weights=None, priority_domains=None, batch_size=BATCH_SIZE, cost=None):
+    """
+    Составляет план сбора, который укладывается в остаток API units.
+
+    Домены упорядочиваются по приоритету, после чего список обрезается так,
+    чтобы оценка стоимости не превышала остаток за вычетом AHREFS_UNITS_RESERVE.
+    Стоимость не убывает с ростом списка, поэтому длина плана находится
+    бинарным поиском (O(log n) оценок стоимости).
+    Если остаток неизвестен (None), запрашиваются все домены.
+
+    Args:
+        domains (list): Список доменов
+        remaining_units (int): Остаток API units или None
+        weights (dict): Словарь {domain: вес} для упорядочивания
+        priority_domains (list): Домены, которые всегда идут первыми
+        batch_size (int): Количество доменов в одном batch запросе
+        cost (callable): Оценка стоимости списка доменов (по умолчанию - batch запросы)
+
+    Returns:
+        BudgetPlan: Домены для запроса, пропущенные домены и оценка стоимости
+    """
+    if cost is None:
+        def cost(planned):
+            return estimate_targets_units(planned, batch_size)
+
+    ordered = prioritize_domains(domains, weights, priority_domains)
+
+    if remaining_units is None:
+        logger.warning("Залишок API units невідомий - плануємо збір для всіх доменів")
+        return BudgetPlan(ordered, [], cost(ordered))
+
+    budget = remaining_units - AHREFS_UNITS_RESERVE
+    # Наибольшее count, при котором cost(ordered[:count]) <= budget
+    low, high = 0, len(ordered)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if cost(ordered[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    count = low
+
+    plan = BudgetPlan(ordered[:count], ordered[count:], cost(ordered[:count]))
+    if plan.skipped:
+        logger.warning(f"Бюджету API units ({remaining_units}) вистачає на {count} з {len(ordered)} доменів. "
+                       f"Пропущено {len(plan.skipped)} найменш пріоритетних доменів.")
+    else:
+        logger.info(f"Бюджет API units: {remaining_units}, оцінка витрат: {plan.estimated_units}")
+    return plan
+
+def load_freshness_windows(path=FRESHNESS_WINDOWS_FILE):
+    """
+    Загружает окна свежести для отдельных доменов (строки вида "домен дни").
+
+    Returns:
+        dict: Словарь {domain: дни} или пустой словарь, если файла нет
+    """
+    if not os.path.exists(path):
+        return {}
+    windows = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            try:
+                domain, days = parts
+                windows[domain] = int(days)
+            except ValueError:
+                logger.warning(f"Некоректний рядок у {path}: '{line.strip()}' (очікується \"домен дні\")")
+    return windows
+
+def find_last_fetch(dates, cells):
+    """
+    Находит последнее успешно полученное значение в строке листа (колонки от новых к старым).
+
+    Args:
+        dates (list): Даты колонок в формате YYYY-MM-DD
+        cells (list): Значения строки в тех же колонках
+
+    Returns:
+        LastFetch: Дата и значение или None, если значений нет
+    """
+    for date, cell in zip(dates, cells):
+        try:
+            return LastFetch(datetime.strptime(date, '%Y-%m-%d').date(), int(cell))
+        except (ValueError, TypeError):
+            continue
+    return None
+
+def plan_freshness(domains, last_fetches, current_date, windows=None, default_days=AHREFS_FRESHNESS_DAYS):
+    """
+    Отбирает домены, значения которых устарели.
+
+    Домен свежий, если его последнее значение моложе окна свежести (в днях).
+    Окно 1 означает "запрашивать, если нет значения за сегодня", 0 - "запрашивать всегда".
+
+    Args:
+        domains (list): Список доменов
+        last_fetches (dict): Словарь {domain: LastFetch}
+        current_date (date): Текущая дата
+        windows (dict): Окна свежести для отдельных доменов {domain: дни}
+        default_days (int): Окно свежести по умолчанию
+
+    Returns:
+        FreshnessPlan: Устаревшие домены и словарь {domain: значение} для свежих
+    """
+    windows = windows or {}
+    stale = []
+    fresh = {}
+    for domain in domains:
+        last_fetch = last_fetches.get(domain)
+        if last_fetch is not None and (current_date - last_fetch.date).days < windows.get(domain, default_days):
+            fresh[domain] = last_fetch.value
+        else:
+            stale.append(domain)
+
+    logger.info(f"Свіжість даних: {len(stale)} доменів потрібно оновити, {len(fresh)} доменів мають свіжі значення")
+    return FreshnessPlan(stale, fresh)
+
+# Интервал между регулярными запусками (колонками листа) в днях
+BACKFILL_INTERVAL_DAYS = 7
+
+def find_missing_weeks(dates, interval_days=BACKFILL_INTERVAL_DAYS):
+    """
+    Находит пропущенные недельные даты между существующими колонками листа.
+
+    Между соседними колонками ожидается шаг interval_days. Если разрыв больше,
+    недостающие даты добавляются с этим шагом от более старой колонки (дата,
+    которая ближе половины шага к следующей колонке, не добавляется).
+
+    Args:
+        dates (list): Даты колонок (YYYY-MM-DD) в любом порядке
+
+    Returns:
+        list: Пропущенные даты (YYYY-MM-DD) от новых к старым
+    """
+    parsed = set()
+    for date in dates:
+        try:
+            parsed.add(datetime.strptime(date, '%Y-%m-%d').date())
+        except (ValueError, TypeError):
+            continue
+    ordered = sorted(parsed)
+
+    missing = []
+    for older, newer in zip(ordered, ordered[1:]):
+        candidate = older + timedelta(days=interval_days)
+        while (newer - candidate).days > interval_days // 2:
+            missing.append(candidate)
+            candidate += timedelta(days=interval_days)
+    return [date.strftime('%Y-%m-%d') for date in sorted(missing, reverse=True)]
+
+def pick_history_value(history, date):
+    """
+    Выбирает значение из недельной истории для даты колонки: последнюю точку не позже даты.
+
+    Args:
+        history (dict): Словарь {дата: трафик}
+        date (str): Дата колонки (YYYY-MM-DD)
+
+    Returns:
+        int: Трафик или None, если точек до этой даты нет
+    """
+    points = [point for point in history if point <= date]
+    if not points:
+        return None
+    return history[max(points)]
@@ -11,6 +11,7 @@ from config import (
 )
 from ahrefs_api import get_organic_traffic, check_api_availability, is_api_limit_reached, get_api_limit_message, should_skip_execution_due_to_limit
 from telegram_bot import notify_traffic_update, send_message, run_bot
+from run_deadline import run_deadline_scope
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,12 +28,19 @@ def collect_traffic_data(mode: str = 'production', send_notifications: bool = Tr
     """
     Собирает данные о трафике для всех доменов.
 
+    Дедлайн запуска действует только на время сбора: процесс бота живет дольше,
+    и следующий сбор начинается с новым дедлайном.
+
     Args:
         mode (str): Режим работы ('production' или 'test')
         send_notifications (bool): Отправлять ли уведомления в Telegram
     """
     logger.info(f"Начало сбора данных о трафике (режим: {mode})")
+    with run_deadline_scope():
+        _collect_traffic_data(mode, send_notifications)
 
+def _collect_traffic_data(mode, send_notifications):
+    """Сбор данных о трафике (см. collect_traffic_data)"""
     # Проверка: нужно ли пропустить выполнение из-за лимита API
     if should_skip_execution_due_to_limit():
         logger.info("Виконання скрипту пропущено - ліміт API досягнуто, очікуємо 24 число")
@@ -44,6 +52,13 @@ def collect_traffic_data(mode: str = 'production', send_notifications: bool = Tr
 
     # Проверка доступности API
     if not check_api_availability():
+        if is_api_limit_reached():
+            # Units исчерпаны на всех ключах: ключи отключены до 24 числа, как после 403
+            if send_notifications:
+                limit_message = get_api_limit_message()
+                if limit_message:
+                    send_message(limit_message, parse_mode='Markdown')
+            return
         if send_notifications:
             message = "⚠️ *Ошибка*\nAPI Ahrefs недоступно. Сбор данных невозможен."
             send_message(message, parse_mode='Markdown')
@@ -0,0 +1,118 @@
+"""
+Общий дедлайн запуска.
+
+Запуск (test_runner, цикл сбора main.py) начинается с start_run_deadline().
+В долгоживущем процессе (бот main.py) сбор оборачивается в run_deadline_scope(),
+чтобы после сбора дедлайн снимался и не влиял на следующие вызовы.
+Сетевые вызовы Ahrefs, Google Sheets и Telegram берут таймауты не больше
+оставшегося времени, а сбор данных Ahrefs останавливается заранее, оставляя
+RUN_DEADLINE_RESERVE секунд на запись в Google Sheets и уведомления.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from config import RUN_DEADLINE_SECONDS, RUN_DEADLINE_RESERVE
+
+logger = logging.getLogger(__name__)
+
+# Минимальный таймаут вызова, который нельзя пропустить (запись результатов, уведомление)
+MIN_CALL_TIMEOUT = 5.0
+
+class DeadlineExceeded(Exception):
+    """Время запуска исчерпано - новые сетевые запросы не отправляются"""
+
+class Deadline:
+    """
+    Момент, к которому запуск должен завершиться.
+
+    Args:
+        seconds (float): Сколько секунд осталось (None или 0 - без дедлайна)
+    """
+
+    def __init__(self, seconds=None):
+        self.expires_at = time.monotonic() + seconds if seconds else None
+
+    def remaining(self, reserve=0.0):
+        """Оставшееся время в секундах с учетом резерва (None - без дедлайна)"""
+        if self.expires_at is None:
+            return None
+        return self.expires_at - reserve - time.monotonic()
+
+    def expired(self, reserve=0.0):
+        remaining = self.remaining(reserve)
+        return remaining is not None and remaining <= 0
+
+    def timeout(self, default, reserve=0.0, floor=None):
+        """
+        Таймаут вызова: default, но не больше оставшегося времени.
+
+        Args:
+            default (float): Обычный таймаут вызова
+            reserve (float): Сколько секунд оставить после вызова
+            floor (float): Минимальный таймаут; если задан, вызов выполняется даже
+                           после дедлайна (запись результатов, уведомления)
+
+        Returns:
+            float: Таймаут в секундах
+
+        Raises:
+            DeadlineExceeded: Если время истекло, а floor не задан
+        """
+        remaining = self.remaining(reserve)
+        if remaining is None:
+            return default
+        if floor is not None:
+            return max(floor, min(default, remaining))
+        if remaining <= 0:
+            raise DeadlineExceeded("Час запуску вичерпано")
+        return min(default, remaining)
+
+# Дедлайн текущего запуска (по умолчанию - без ограничения)
+_run_deadline = Deadline()
+_run_deadline_lock = threading.Lock()
+
+def start_run_deadline(seconds=RUN_DEADLINE_SECONDS):
+    """Начинает отсчет дедлайна нового запуска"""
+    global _run_deadline
+    with _run_deadline_lock:
+        _run_deadline = Deadline(seconds)
+    if seconds:
+        logger.info(f"Дедлайн запуску: {seconds:.0f} с (резерв на запис і сповіщення: {RUN_DEADLINE_RESERVE:.0f} с)")
+    return _run_deadline
+
+def clear_run_deadline():
+    """Снимает дедлайн (после завершения запуска в долгоживущем процессе)"""
+    global _run_deadline
+    with _run_deadline_lock:
+        _run_deadline = Deadline()
+
+@contextmanager
+def run_deadline_scope(seconds=RUN_DEADLINE_SECONDS):
+    """
+    Дедлайн на время одного запуска: начинается на входе и снимается на выходе
+    (в том числе при исключении или раннем возврате).
+
+    Пример:
+        with run_deadline_scope():
+            collect()
+    """
+    deadline = start_run_deadline(seconds)
+    try:
+        yield deadline
+    finally:
+        clear_run_deadline()
+
+def run_deadline():
+    """Дедлайн текущего запуска"""
+    return _run_deadline
+
+def fetch_time_left():
+    """
+    Сколько секунд осталось на сбор данных (с учетом резерва на запись и уведомления).
+
+    Returns:
+        float: Оставшееся время или None, если дедлайна нет
+    """
+    return _run_deadline.remaining(RUN_DEADLINE_RESERVE)
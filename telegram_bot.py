@@ -1,7 +1,8 @@
 import logging
 from telegram import Update, ParseMode
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT
+from run_deadline import MIN_CALL_TIMEOUT, run_deadline
 from typing import Dict, Any, List, Union
 import json
 import os
@@ -34,9 +35,19 @@ def get_updater():
     """Возвращает глобальный экземпляр updater."""
     global updater_instance
     if updater_instance is None:
-        updater_instance = Updater(TELEGRAM_BOT_TOKEN)
+        updater_instance = Updater(TELEGRAM_BOT_TOKEN, request_kwargs={
+            'connect_timeout': TELEGRAM_CONNECT_TIMEOUT,
+            'read_timeout': TELEGRAM_READ_TIMEOUT,
+        })
     return updater_instance
 
+def _send_timeout():
+    """
+    Таймаут отправки сообщения: TELEGRAM_READ_TIMEOUT, но не дольше времени до
+    дедлайна запуска. Уведомление отправляется даже после дедлайна - с минимальным таймаутом.
+    """
+    return run_deadline().timeout(TELEGRAM_READ_TIMEOUT, floor=MIN_CALL_TIMEOUT)
+
 def load_chat_id():
     """Загружает chat_id из файла."""
     global chat_id, chat_ids
@@ -251,7 +262,7 @@ def notify_traffic_update(domains_data, mode='production'):
         if mode == 'test':
             message = "🔄 Оновлення даних про трафік\n\nНемає доменів з критичним падінням трафіку (або значення трафіку некоректні)."
             try:
-                get_updater().bot.send_message(chat_id=chat_id, text=message)
+                get_updater().bot.send_message(chat_id=chat_id, text=message, timeout=_send_timeout())
             except Exception as e:
                 logger.error("Ошибка при отправке сообщения в Telegram: %s", str(e))
         return
@@ -292,13 +303,14 @@ def notify_traffic_update(domains_data, mode='production'):
             get_updater().bot.send_message(
                 chat_id=chat_id,
                 text=message,
-                parse_mode='HTML'
+                parse_mode='HTML',
+                timeout=_send_timeout()
             )
         except Exception as e:
             logger.error("Ошибка при отправке сообщения в Telegram: %s", str(e))
             # Пробуем отправить без форматирования
             try:
-                get_updater().bot.send_message(chat_id=chat_id, text=message)
+                get_updater().bot.send_message(chat_id=chat_id, text=message, timeout=_send_timeout())
             except Exception as e:
                 logger.error("Повторная ошибка при отправке сообщения в Telegram: %s", str(e))
 
@@ -392,7 +404,8 @@ def send_message_to_chats(message: str, parse_mode: str = None, test_mode: bool
                 get_updater().bot.send_message(
                     chat_id=cid,
                     text=final_message,
-                    parse_mode=parse_mode
+                    parse_mode=parse_mode,
+                    timeout=_send_timeout()
                 )
                 chat_success = True
                 logger.info(f"Частина {i+1}/{len(message_parts)} успішно відправлена в чат {cid}")
@@ -400,7 +413,7 @@ def send_message_to_chats(message: str, parse_mode: str = None, test_mode: bool
                 logger.error(f"Помилка при відправці частини {i+1} в чат {cid}: {str(e)}")
                 try:
                     # Пробуем отправить без форматирования
-                    get_updater().bot.send_message(chat_id=cid, text=final_message)
+                    get_updater().bot.send_message(chat_id=cid, text=final_message, timeout=_send_timeout())
                     chat_success = True
                     logger.info(f"Частина {i+1} успішно відправлена без форматування в чат {cid}")
                 except Exception as e2:
@@ -474,7 +487,8 @@ def send_message_to_specific_chats(message: str, target_chat_ids: List[str], par
                 get_updater().bot.send_message(
                     chat_id=int(chat_id),
                     text=final_message,
-                    parse_mode=parse_mode
+                    parse_mode=parse_mode,
+                    timeout=_send_timeout()
                 )
                 chat_success = True
                 logger.info(f"Частина {i+1}/{len(message_parts)} успішно відправлена в чат {chat_id}")
@@ -482,7 +496,8 @@ def send_message_to_specific_chats(message: str, target_chat_ids: List[str], par
                 logger.error(f"Помилка при відправці частини {i+1} в чат {chat_id}: {str(e)}")
                 try:
                     # Пробуем отправить без форматирования
-                    get_updater().bot.send_message(chat_id=int(chat_id), text=final_message)
+                    get_updater().bot.send_message(chat_id=int(chat_id), text=final_message,
+                                                   timeout=_send_timeout())
                     chat_success = True
                     logger.info(f"Частина {i+1} успішно відправлена без форматування в чат {chat_id}")
                 except Exception as e2:
@@ -1,7 +1,7 @@
 import logging
 import os
 from datetime import datetime
-from ahrefs_api import get_organic_traffic, check_api_availability
+from ahrefs_api import get_organic_traffic, check_api_availability, should_skip_execution_due_to_limit
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,6 +19,11 @@ def test_ahrefs_api():
         logger.error("AHREFS_API_KEY не найден в переменных окружения")
         return False
     
+    # Лимит API, достигнутый в предыдущем запуске, еще действует - запросы не отправляем
+    if should_skip_execution_due_to_limit():
+        logger.warning("Лимит API достигнут в предыдущем запуске, тестовые запросы пропущены")
+        return False
+    
     # Проверка доступности API
     logger.info("Проверка доступности API Ahrefs...")
     if not check_api_availability():
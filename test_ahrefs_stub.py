@@ -0,0 +1,360 @@
+"""
+Офлайн-тест клиента Ahrefs против локального заменителя API (ahrefs_stub_server).
+
+Заменитель запускается в этом же процессе, поэтому настоящий ключ и сеть не нужны:
+
+    python test_ahrefs_stub.py
+
+Проверяются повторы после 429/5xx, 403 без отношения к лимиту, переключение
+ключей и исчерпание лимита units, а также чистые функции планирования
+(normalize_target, find_missing_weeks, plan_budget, AdaptiveBatchSizer, _read_body).
+"""
+import gzip
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime
+
+from ahrefs_stub_server import start_stub_server, stub_traffic
+
+# Настройка логирования
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# config требует токен бота при импорте; для офлайн-теста он не нужен
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "stub")
+
+import ahrefs_api  # noqa: E402
+import ahrefs_targets  # noqa: E402
+from ahrefs_api import (  # noqa: E402
+    METRICS_ENDPOINT, AdaptiveBatchSizer, AdaptiveRateLimiter, AhrefsConnectionPool, AhrefsKeyPool,
+    ResponsePathExtractor, ResponseTooLargeError, SingleFlight, TrafficResult, check_api_health,
+    fetch_current_organic_traffic, get_batch_organic_traffic, is_api_limit_reached, iter_sized_batches,
+    reset_api_limit_flag
+)
+from ahrefs_cache import AhrefsResponseCache  # noqa: E402
+from ahrefs_targets import AhrefsTarget, normalize_target  # noqa: E402
+from config import AHREFS_UNITS_RESERVE, RUN_DEADLINE_RESERVE  # noqa: E402
+from fetch_planner import find_missing_weeks, plan_budget  # noqa: E402
+from run_deadline import DeadlineExceeded, run_deadline_scope  # noqa: E402
+
+# Ключи заменителя API (настоящие ключи в тесте не используются)
+STUB_API_KEYS = ["stub-key-1", "stub-key-2"]
+
+_stub = start_stub_server(retry_after=0.01, seed=1)
+_stub_host = f"127.0.0.1:{_stub.server_address[1]}"
+_state_dir = tempfile.mkdtemp(prefix="ahrefs_stub_test_")
+
+def _use_stub():
+    """
+    Направляет клиент ahrefs_api на заменитель API.
+
+    Пул соединений, ключи, ограничитель запросов, кэш и файл состояния лимита
+    создаются заново, а не берутся из конфигурации при импорте: модуль мог быть
+    импортирован раньше (например, другим тестом) с настоящими AHREFS_API_URL и ключом.
+    """
+    ahrefs_api._api_url = ahrefs_api.urlparse(f"http://{_stub_host}")
+    ahrefs_api._connection_pool = AhrefsConnectionPool(_stub_host, scheme="http")
+    ahrefs_api.AHREFS_API_KEYS = STUB_API_KEYS
+    ahrefs_api._key_pool = AhrefsKeyPool(STUB_API_KEYS)
+    ahrefs_api._rate_limiter = AdaptiveRateLimiter(rate=1000, burst=100, max_concurrency=8, max_pause=1)
+    ahrefs_api._response_cache = AhrefsResponseCache(directory=os.path.join(_state_dir, "cache"), ttl=0)
+    ahrefs_api._single_flight = SingleFlight()
+    ahrefs_api._batch_sizer = AdaptiveBatchSizer()
+    ahrefs_api.AHREFS_LIMIT_STATE_FILE = os.path.join(_state_dir, "api_limit_state.json")
+    ahrefs_api.AHREFS_RETRY_BASE_DELAY = 0.01
+    ahrefs_api.AHREFS_RETRY_MAX_DELAY = 0.05
+    ahrefs_api.AHREFS_MAX_RETRIES = 6
+    ahrefs_api.AHREFS_MAX_THROTTLE_RETRIES = 6
+    ahrefs_api._api_limit_reached = False
+
+def _assert_uses_stub():
+    """Останавливает тест, если клиент смотрит не на заменитель API (иначе тратятся настоящие units)"""
+    if ahrefs_api._connection_pool.host != _stub_host or ahrefs_api._connection_pool.scheme != "http" \
+            or [key.key for key in ahrefs_api._key_pool.keys] != STUB_API_KEYS:
+        logger.error(f"Клієнт Ahrefs спрямовано не на замінник API ({_stub_host}) - тест зупинено")
+        sys.exit(1)
+
+_use_stub()
+_assert_uses_stub()
+
+def _configure_stub(**options):
+    """Меняет настройки заменителя и обнуляет расход units"""
+    _assert_uses_stub()
+    state = _stub.stub_state
+    for name, value in options.items():
+        setattr(state, name, value)
+    state.units_used = 0
+    state.units_by_key = {}
+
+def test_normalize_target():
+    assert normalize_target("example.com") == AhrefsTarget("example.com", "domain")
+    assert normalize_target("https://www.example.com/") == AhrefsTarget("www.example.com", "domain")
+    assert normalize_target("*.example.com") == AhrefsTarget("example.com", "subdomains")
+    assert normalize_target("exact:example.com/ua/") == AhrefsTarget("example.com/ua/", "exact")
+
+    # До перехода на режимы разделов запись с путем запрашивается в режиме domain
+    assert normalize_target("example.com/ua") == AhrefsTarget("example.com/ua", "domain")
+
+    since = ahrefs_targets.AHREFS_PATH_MODES_SINCE
+    ahrefs_targets.AHREFS_PATH_MODES_SINCE = "2026-01-05"
+    try:
+        assert normalize_target("example.com/ua") == AhrefsTarget("example.com/ua", "prefix")
+        assert normalize_target("example.com/ua/page.html") == AhrefsTarget("example.com/ua/page.html", "exact")
+        assert normalize_target("example.com/search?q=1") == AhrefsTarget("example.com/search?q=1", "exact")
+        assert ahrefs_targets.history_start("example.com/ua") == "2026-01-05"
+        assert ahrefs_targets.history_start("example.com") is None
+    finally:
+        ahrefs_targets.AHREFS_PATH_MODES_SINCE = since
+
+    assert ahrefs_targets.unique_targets(["www.example.com", "example.com", "example.org"]) == \
+        ["www.example.com", "example.org"]
+    try:
+        normalize_target("https:///path")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("запис без хоста має викликати ValueError")
+
+def test_find_missing_weeks():
+    assert find_missing_weeks([]) == []
+    assert find_missing_weeks(["2026-01-05", "2026-01-12"]) == []
+    assert find_missing_weeks(["2026-01-26", "2026-01-05"]) == ["2026-01-19", "2026-01-12"]
+    # Дата ближе половины шага к следующей колонке не добавляется
+    assert find_missing_weeks(["2026-01-05", "2026-01-15"]) == []
+    assert find_missing_weeks(["2026-01-05", "не дата", "2026-01-19"]) == ["2026-01-12"]
+
+def test_plan_budget():
+    domains = [f"site{i}.com" for i in range(10)]
+    cost = len
+
+    plan = plan_budget(domains, None, cost=cost)
+    assert plan.domains == domains and plan.skipped == []
+
+    plan = plan_budget(domains, AHREFS_UNITS_RESERVE + 3, priority_domains=["site9.com"], cost=cost)
+    assert plan.domains == ["site9.com", "site0.com", "site1.com"]
+    assert plan.estimated_units == 3 and len(plan.skipped) == 7
+
+    assert plan_budget(domains, 0, cost=cost).domains == []
+    assert plan_budget(domains, AHREFS_UNITS_RESERVE + 100, cost=cost).domains == domains
+
+def test_sized_batches_keep_priority():
+    since = ahrefs_targets.AHREFS_PATH_MODES_SINCE
+    ahrefs_targets.AHREFS_PATH_MODES_SINCE = "2026-01-05"
+    try:
+        domains = ["a.com", "b.com", "c.com/blog/", "d.com", "e.com", "f.com", "g.com/page.html"]
+        batches = [(batch.mode, [target.target for target in batch.targets])
+                   for batch in iter_sized_batches(domains, batch_size=2)]
+    finally:
+        ahrefs_targets.AHREFS_PATH_MODES_SINCE = since
+    # Раздел с высоким приоритетом идет раньше менее приоритетных доменов
+    assert batches == [
+        ("domain", ["a.com", "b.com"]),
+        ("prefix", ["c.com/blog/"]),
+        ("domain", ["d.com", "e.com"]),
+        ("domain", ["f.com"]),
+        ("exact", ["g.com/page.html"]),
+    ], batches
+
+def test_batch_sizer_record():
+    sizer = AdaptiveBatchSizer(initial=40, min_size=5, max_size=100, target_latency=10,
+                               max_response_bytes=1000)
+    sizer.record(40, latency=1)
+    assert sizer.size == 50
+    # Маленький batch (повтор половины) на размер не влияет, даже если он не удался
+    sizer.record(10, failed=True)
+    assert sizer.size == 50
+    sizer.record(50, failed=True)
+    assert sizer.size == 25
+    sizer.record(25, latency=20)
+    assert sizer.size == 12
+    sizer.record(12, response_bytes=600)
+    assert sizer.size == 6
+    sizer.record(6, failed=True)
+    assert sizer.size == 5
+
+def test_rate_limiter_caps_retry_after():
+    limiter = AdaptiveRateLimiter(rate=100, burst=10, max_concurrency=4, max_pause=0.2)
+    limiter.acquire()
+    # Retry-After больше max_pause: запрос не повторяется, остальные потоки ждут не дольше max_pause
+    limiter.release(throttled=True, retry_after=3600)
+    started = time.monotonic()
+    limiter.acquire()
+    limiter.release()
+    assert time.monotonic() - started < 1
+
+def test_rate_limiter_stops_at_deadline():
+    limiter = AdaptiveRateLimiter(rate=100, burst=10, max_concurrency=4, max_pause=3600)
+    limiter.acquire()
+    limiter.release(throttled=True, retry_after=3600)
+    started = time.monotonic()
+    with run_deadline_scope(RUN_DEADLINE_RESERVE + 0.3):
+        try:
+            limiter.acquire()
+        except DeadlineExceeded:
+            pass
+        else:
+            raise AssertionError("очікування обмежувача має зупинятися на дедлайні")
+    assert time.monotonic() - started < 2
+
+def test_path_extractor_missing_field():
+    extractor = ResponsePathExtractor("org_traffic")
+    # Ответ без поля не мешает найти поле в следующих ответах того же endpoint'а
+    assert extractor.extract(METRICS_ENDPOINT, {"metrics": {"org_keywords": 1}}) is None
+    assert extractor.extract(METRICS_ENDPOINT, {"metrics": {"org_traffic": 42}}) == 42
+    assert extractor.extract(METRICS_ENDPOINT, {"metrics": {"org_keywords": 1}}) is None
+    assert extractor.extract(METRICS_ENDPOINT, {"metrics": {"org_traffic": 0}}) == 0
+    # Структура ответа изменилась - путь ищется заново
+    assert extractor.extract(METRICS_ENDPOINT, {"data": {"org_traffic": 7}}) == 7
+
+class _BodyResponse:
+    """Ответ http.client с заданным телом и Content-Encoding"""
+
+    def __init__(self, body, encoding=None):
+        self._body = io.BytesIO(body)
+        self._encoding = encoding
+
+    def getheader(self, name):
+        return self._encoding if name == 'Content-Encoding' else None
+
+    def read(self, size):
+        return self._body.read(size)
+
+def test_read_body():
+    pool = AhrefsConnectionPool("127.0.0.1", scheme="http", max_response_bytes=1000)
+    payload = b'{"metrics": {"org_traffic": 1}}'
+    raw_deflate = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+
+    assert pool._read_body(_BodyResponse(payload)) == payload
+    assert pool._read_body(_BodyResponse(gzip.compress(payload), 'gzip')) == payload
+    assert pool._read_body(_BodyResponse(zlib.compress(payload), 'deflate')) == payload
+    assert pool._read_body(_BodyResponse(raw_deflate.compress(payload) + raw_deflate.flush(), 'deflate')) == payload
+
+    # Сжатый ответ больше лимита после распаковки прерывается
+    try:
+        pool._read_body(_BodyResponse(gzip.compress(b"0" * 100000), 'gzip'))
+    except ResponseTooLargeError:
+        pass
+    else:
+        raise AssertionError("відповідь понад max_response_bytes має перериватися")
+
+def test_retries_after_429_and_5xx():
+    _configure_stub(error_429=0.2, error_5xx=0.2, error_403=0.0, key_units_limit=None)
+    today = datetime.now().strftime('%Y-%m-%d')
+    injected_before = dict(_stub.stub_state.stats()["injected_errors"])
+
+    domains = [f"retry{i}.com" for i in range(12)]
+    for domain in domains[:6]:
+        result = fetch_current_organic_traffic(domain)
+        assert result.status == TrafficResult.OK, (domain, result)
+        assert result.value == stub_traffic(domain, "domain", today)
+
+    results = get_batch_organic_traffic(domains[6:])
+    for domain in domains[6:]:
+        assert results[domain].status == TrafficResult.OK, (domain, results[domain])
+        assert results[domain].value == stub_traffic(domain, "domain", today)
+
+    injected = _stub.stub_state.stats()["injected_errors"]
+    assert injected["429"] > injected_before["429"], "заміна API не повернула жодного 429"
+    assert injected["5xx"] > injected_before["5xx"], "заміна API не повернула жодного 5xx"
+    assert not is_api_limit_reached()
+
+def test_forbidden_is_not_limit():
+    _configure_stub(error_429=0.0, error_5xx=0.0, error_403=1.0, key_units_limit=None)
+    try:
+        result = fetch_current_organic_traffic("forbidden.com")
+    finally:
+        _configure_stub(error_403=0.0)
+    assert result.status == TrafficResult.MISSING, result
+    assert not is_api_limit_reached()
+    assert not any(key.tripped for key in ahrefs_api._key_pool.keys)
+    assert fetch_current_organic_traffic("forbidden.com").status == TrafficResult.OK
+
+def test_key_rotation_and_units_limit():
+    # Каждый запрос metrics стоит 50 units: на каждый ключ приходится два запроса
+    _configure_stub(error_429=0.0, error_5xx=0.0, error_403=0.0, key_units_limit=100)
+    state_file = ahrefs_api.AHREFS_LIMIT_STATE_FILE
+    try:
+        for i in range(4):
+            result = fetch_current_organic_traffic(f"rotation{i}.com")
+            assert result.status == TrafficResult.OK, (i, result)
+        # Первый ключ отключен после 403 об исчерпанном лимите, запрос повторен вторым ключом
+        tripped = [key.fingerprint for key in ahrefs_api._key_pool.keys if key.tripped]
+        assert len(tripped) == 1, tripped
+        assert _stub.stub_state.stats()["keys"] == 2
+        assert not is_api_limit_reached()
+
+        result = fetch_current_organic_traffic("rotation4.com")
+        assert result.status == TrafficResult.LIMIT_REACHED, result
+        assert is_api_limit_reached()
+        assert ahrefs_api._key_pool.all_tripped
+        assert set(ahrefs_api._load_limit_state()) == {key.fingerprint for key in ahrefs_api._key_pool.keys}
+
+        # После достижения лимита запросы больше не отправляются
+        requests_before = _stub.stub_state.stats()["requests"]
+        assert fetch_current_organic_traffic("rotation5.com").status == TrafficResult.LIMIT_REACHED
+        assert _stub.stub_state.stats()["requests"] == requests_before
+    finally:
+        reset_api_limit_flag()
+        _configure_stub(key_units_limit=None)
+    assert not os.path.exists(state_file)
+
+def test_health_check_trips_exhausted_keys():
+    # Остаток units ключей уже исчерпан: subscription-info бесплатный и отвечает всегда
+    _configure_stub(error_429=0.0, error_5xx=0.0, error_403=0.0, key_units_limit=100)
+    _stub.stub_state.units_by_key = {key: 100 for key in STUB_API_KEYS}
+    state_file = ahrefs_api.AHREFS_LIMIT_STATE_FILE
+    try:
+        health = check_api_health(refresh=True)
+        assert not health.available
+        assert ahrefs_api._key_pool.all_tripped
+        assert is_api_limit_reached()
+        assert set(ahrefs_api._load_limit_state()) == {key.fingerprint for key in ahrefs_api._key_pool.keys}
+    finally:
+        reset_api_limit_flag()
+        _configure_stub(key_units_limit=None)
+    assert not os.path.exists(state_file)
+
+TESTS = [
+    test_normalize_target,
+    test_find_missing_weeks,
+    test_plan_budget,
+    test_sized_batches_keep_priority,
+    test_batch_sizer_record,
+    test_rate_limiter_caps_retry_after,
+    test_rate_limiter_stops_at_deadline,
+    test_path_extractor_missing_field,
+    test_read_body,
+    test_retries_after_429_and_5xx,
+    test_forbidden_is_not_limit,
+    test_key_rotation_and_units_limit,
+    test_health_check_trips_exhausted_keys,
+]
+
+def run_tests():
+    """Запускает все проверки; возвращает True, если все прошли"""
+    failed = 0
+    for test in TESTS:
+        try:
+            test()
+        except Exception:
+            failed += 1
+            logger.exception(f"❌ {test.__name__}")
+        else:
+            logger.info(f"✅ {test.__name__}")
+    logger.info(f"Пройдено {len(TESTS) - failed} з {len(TESTS)} перевірок")
+    return failed == 0
+
+if __name__ == "__main__":
+    success = run_tests()
+    _stub.shutdown()
+    if not success:
+        logger.error("Офлайн-тест клієнта Ahrefs завершився з помилкою")
+        sys.exit(1)
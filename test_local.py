@@ -15,7 +15,7 @@ except ImportError:
     pass
 
 from telegram_bot import send_message
-from ahrefs_api import check_api_availability, get_organic_traffic
+from ahrefs_api import check_api_availability, get_organic_traffic, should_skip_execution_due_to_limit
 
 # Налаштування логування
 logging.basicConfig(
@@ -46,6 +46,10 @@ def test_api():
     """Тестує доступність API Ahrefs"""
     logger.info("=== Перевірка доступності API Ahrefs ===")
     
+    if should_skip_execution_due_to_limit():
+        logger.warning("⚠️ Ліміт API досягнуто в попередньому запуску - перевірку пропущено")
+        return False
+    
     if check_api_availability():
         logger.info("✅ API Ahrefs доступний")
         return True
@@ -93,7 +97,7 @@ def main():
         message = "✅ Тестування API Ahrefs пройшло успішно\n\n"
         message += "📊 Результати трафіку:\n"
         for domain, traffic in results.items():
-            message += f"{domain}: {traffic:,}\n"
+            message += f"{domain}: {traffic:,}\n" if traffic is not None else f"{domain}: немає даних\n"
         
         # Додаємо відмітку часу
         now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
@@ -18,7 +18,17 @@ from datetime import datetime, timedelta
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from telegram_bot import send_message
-from ahrefs_api import get_organic_traffic, get_batch_organic_traffic, check_api_availability, is_api_limit_reached, reset_api_limit_flag, get_api_limit_message, should_skip_execution_due_to_limit
+from ahrefs_api import check_api_availability, is_api_limit_reached, get_api_limit_message, should_skip_execution_due_to_limit, TrafficResult, get_remaining_api_units
+from ahrefs_async import fetch_traffic_concurrently, fetch_history_concurrently, fetch_country_traffic_concurrently
+from fetch_planner import (
+    BudgetPlan, plan_budget, load_priority_domains, find_last_fetch, plan_freshness, load_freshness_windows,
+    BACKFILL_INTERVAL_DAYS, estimate_history_units, estimate_targets_units, find_missing_weeks, pick_history_value
+)
+from ahrefs_targets import history_start, unique_targets
+from config import AHREFS_API_KEYS, AHREFS_EXTRA_METRICS, AHREFS_COUNTRIES, SHEETS_TIMEOUT
+from run_deadline import MIN_CALL_TIMEOUT, fetch_time_left, run_deadline, start_run_deadline
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 
 # Встановлюємо перехоплювач невловлених виключень
 def handle_uncaught_exception(exc_type, exc_value, exc_traceback):
@@ -28,6 +38,9 @@ def handle_uncaught_exception(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = handle_uncaught_exception
 
+# Значение ячейки для домена, трафик которого получить не удалось (не путать с нулевым трафиком)
+MISSING_TRAFFIC_CELL = ''
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.DEBUG,  # Змінено рівень на DEBUG для більше інформації
@@ -40,6 +53,9 @@ logger.info(f"Python версія: {sys.version}")
 logger.info(f"Поточна директорія: {os.getcwd()}")
 logger.info(f"Список файлів в директорії: {', '.join(os.listdir('.')[:10])}...")
 
+# Отсчет дедлайна запуска начинается до первых сетевых вызовов
+start_run_deadline()
+
 # Проверка наличия токенов
 telegram_token = os.getenv('TELEGRAM_BOT_TOKEN')
 ahrefs_token = os.getenv('AHREFS_API_KEY')
@@ -58,21 +74,30 @@ try:
 except (TypeError, IndexError) as e:
     logger.error(f"Помилка при доступі до AHREFS_API_KEY: {str(e)}")
 
-# Трасування виклику функції check_api_availability
-logger.info("Викликаємо check_api_availability()...")
-try:
-    api_available = check_api_availability()
-    logger.info(f"Результат check_api_availability(): {api_available}")
-except Exception as e:
-    logger.error(f"Помилка при перевірці доступності API: {str(e)}")
-    logger.error(f"Traceback: {traceback.format_exc()}")
-
-# Проверка доступности API Ahrefs
-if not check_api_availability():
-    error_message = "❌ API Ahrefs недоступне або невірний ключ API. Перевірте налаштування."
-    logger.error(error_message)
-    send_message(error_message, test_mode=True)
-    raise ValueError(error_message)
+# Если лимит API достигнут в одном из предыдущих запусков, не тратим запросы на проверку доступности
+if should_skip_execution_due_to_limit():
+    logger.warning("Ліміт API досягнуто в попередньому запуску - перевірку доступності API пропущено")
+else:
+    # Трасування виклику функції check_api_availability (безкоштовний запит subscription-info,
+    # результат використовується повторно в run_test)
+    logger.info("Викликаємо check_api_availability()...")
+    try:
+        api_available = check_api_availability()
+        logger.info(f"Результат check_api_availability(): {api_available}")
+    except Exception as e:
+        logger.error(f"Помилка при перевірці доступності API: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        api_available = False
+
+    # Проверка доступности API Ahrefs. Если units исчерпаны на всех ключах, ключи уже
+    # отключены до 24 числа - run_test завершится без запросов и без сообщения об ошибке
+    if not api_available and is_api_limit_reached():
+        logger.warning("API units вичерпано на всіх ключах - збір даних пропущено до оновлення лімітів")
+    elif not api_available:
+        error_message = "❌ API Ahrefs недоступне або невірний ключ API. Перевірте налаштування."
+        logger.error(error_message)
+        send_message(error_message, test_mode=True)
+        raise ValueError(error_message)
 
 def init_sheet(service, sheet_id):
     """
@@ -215,6 +240,9 @@ def analyze_growth_domains(domains_data):
     logger.info(f"Аналізуємо домени з ростом трафіку для {len(domains_data)} доменів")
     
     for domain, data in domains_data.items():
+        # Без текущего значения сравнивать нечего - иначе старые измерения выглядели бы как текущие
+        if data.get('missing'):
+            continue
         history = data.get('history', [])
         if len(history) >= 2:
             # Сортируем историю по дате
@@ -304,6 +332,10 @@ def analyze_traffic_changes(domains_data):
     logger.info(f"Аналізуємо зміни трафіку для {len(domains_data)} доменів (дані свіжі: {days_old} днів тому)")
     
     for domain, data in domains_data.items():
+        # Без текущего значения сравнивать нечего - иначе старые измерения выглядели бы как текущие
+        if data.get('missing'):
+            logger.info(f"Пропускаємо домен {domain}: поточне значення трафіку відсутнє")
+            continue
         history = data.get('history', [])
         if len(history) >= 2:
             # Сортируем историю по дате
@@ -412,6 +444,235 @@ def analyze_traffic_changes(domains_data):
     
     return has_critical_changes, drops_message, growth_message
 
+def build_sheets_service():
+    """
+    Создает сервис Google Sheets API по учетным данным из GOOGLE_SHEETS_CREDENTIALS
+    """
+    try:
+        logger.info("Setting up credentials")
+        creds_json = os.getenv('GOOGLE_SHEETS_CREDENTIALS')
+        if not creds_json:
+            logger.error("GOOGLE_SHEETS_CREDENTIALS not found in environment variables")
+            raise ValueError("GOOGLE_SHEETS_CREDENTIALS not found in environment variables")
+        
+        try:
+            creds_dict = json.loads(creds_json)
+            logger.info("Successfully parsed credentials JSON")
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse credentials JSON: {str(e)}")
+            raise
+        
+        creds = service_account.Credentials.from_service_account_info(
+            creds_dict,
+            scopes=['https://www.googleapis.com/auth/spreadsheets']
+        )
+        logger.info("Credentials setup successfully")
+    except Exception as e:
+        logger.error(f"Error setting up credentials: {str(e)}")
+        raise
+    
+    # Таймаут запросов к Google Sheets не дольше времени до дедлайна запуска
+    # (запись результатов выполняется и после дедлайна - с минимальным таймаутом)
+    timeout = run_deadline().timeout(SHEETS_TIMEOUT, floor=MIN_CALL_TIMEOUT)
+    return build('sheets', 'v4', http=AuthorizedHttp(creds, http=httplib2.Http(timeout=timeout)))
+
+def save_series_sheets(sheet, sheet_id, current_date, domains, series):
+    """
+    Сохраняет ряды значений на отдельные листы с тем же форматом, что и лист
+    Traffic: домены в строках, новые даты слева. Недостающие листы создаются.
+
+    Если столбец за current_date на листе уже есть, он дозаполняется: значения
+    доменов, для которых значение сейчас не получено, сохраняются.
+
+    Args:
+        sheet: Ресурс spreadsheets() Google Sheets API
+        sheet_id (str): ID таблицы
+        current_date (str): Дата нового столбца
+        domains (list): Домены в порядке строк
+        series (dict): Словарь {название листа: {domain: значение}}
+
+    Returns:
+        dict: Словарь {название листа: записанные строки (включая заголовок)}
+    """
+    existing_titles = {
+        item['properties']['title']
+        for item in sheet.get(spreadsheetId=sheet_id, fields='sheets.properties.title').execute().get('sheets', [])
+    }
+    new_titles = [title for title in series if title not in existing_titles]
+    if new_titles:
+        logger.info(f"Створюємо листи: {', '.join(new_titles)}")
+        sheet.batchUpdate(
+            spreadsheetId=sheet_id,
+            body={'requests': [{'addSheet': {'properties': {'title': title}}} for title in new_titles]}
+        ).execute()
+    
+    tables = {}
+    for title, values_by_domain in series.items():
+        values = sheet.values().get(spreadsheetId=sheet_id, range=f'{title}!A1:ZZ').execute().get('values', [])
+        headers = values[0] if values else ['Domain']
+        existing_rows = {row[0]: row[1:] for row in values[1:] if row}
+        
+        # Столбец за сегодня пересобирается: старые значения остаются для доменов без нового значения
+        if len(headers) > 1 and headers[1] == current_date:
+            headers = headers[:1] + headers[2:]
+            today_cells = {domain: cells[0] if cells else MISSING_TRAFFIC_CELL for domain, cells in existing_rows.items()}
+            existing_rows = {domain: cells[1:] for domain, cells in existing_rows.items()}
+        else:
+            today_cells = {}
+        
+        new_values = [['Domain', current_date] + headers[1:]]
+        for domain in domains:
+            value = values_by_domain.get(domain)
+            cell = str(value) if value is not None else today_cells.get(domain, MISSING_TRAFFIC_CELL)
+            new_values.append([domain, cell] + existing_rows.get(domain, []))
+        
+        sheet.values().clear(spreadsheetId=sheet_id, range=f'{title}!A1:ZZ').execute()
+        result = sheet.values().update(
+            spreadsheetId=sheet_id,
+            range=f'{title}!A1',
+            valueInputOption='RAW',
+            body={'values': new_values}
+        ).execute()
+        logger.info(f"Лист {title}: {result.get('updatedCells')} ячеек оновлено")
+        tables[title] = new_values
+    return tables
+
+def save_metric_sheets(sheet, sheet_id, current_date, domains, traffic_data):
+    """
+    Сохраняет дополнительные метрики (AHREFS_EXTRA_METRICS) на отдельные листы
+    с названием метрики (см. save_series_sheets).
+
+    Args:
+        sheet: Ресурс spreadsheets() Google Sheets API
+        sheet_id (str): ID таблицы
+        current_date (str): Дата нового столбца
+        domains (list): Домены в порядке строк
+        traffic_data (dict): Словарь {domain: TrafficResult}
+    """
+    metrics_by_domain = {domain: result.metrics for domain, result in traffic_data.items() if result.metrics}
+    if not AHREFS_EXTRA_METRICS or not metrics_by_domain:
+        logger.info("Додаткові метрики не отримано - листи метрик не оновлюються")
+        return
+    
+    save_series_sheets(sheet, sheet_id, current_date, domains, {
+        metric: {domain: metrics.get(metric) for domain, metrics in metrics_by_domain.items()}
+        for metric in AHREFS_EXTRA_METRICS
+    })
+
+def country_sheet_title(country):
+    """Название листа с трафиком из страны country"""
+    return f"Traffic_{country.upper()}"
+
+def collect_country_traffic(domains):
+    """
+    Получает трафик доменов по странам AHREFS_COUNTRIES в рамках остатка API units.
+
+    Домены идут в порядке приоритета: если остатка не хватает на все страны,
+    отбрасываются наименее важные домены.
+
+    Args:
+        domains (list): Домены, для которых получен общий трафик (в порядке приоритета)
+
+    Returns:
+        dict: Словарь {страна: {domain: TrafficResult}}
+    """
+    if not AHREFS_COUNTRIES or not domains:
+        return {}
+    if is_api_limit_reached():
+        logger.warning("Трафік за країнами не збирається - ліміт API досягнуто")
+        return {}
+    time_left = fetch_time_left()
+    if time_left is not None and time_left <= 0:
+        logger.warning("⏱ Трафік за країнами не збирається - час на збір даних вичерпано")
+        return {}
+    
+    # Каждая страна - отдельный набор batch запросов
+    plan = plan_budget(domains, get_remaining_api_units(),
+                       cost=lambda planned: len(AHREFS_COUNTRIES) * estimate_targets_units(planned))
+    if plan.skipped:
+        logger.warning(f"Бюджету API units вистачає на трафік за країнами лише для {len(plan.domains)} "
+                       f"з {len(domains)} доменів")
+    if not plan.domains:
+        return {}
+    
+    country_traffic = fetch_country_traffic_concurrently(plan.domains, AHREFS_COUNTRIES)
+    for country, results in country_traffic.items():
+        for domain in plan.skipped:
+            results[domain] = TrafficResult.limit_reached()
+        fetched = sum(1 for result in results.values() if result.is_ok)
+        logger.info(f"Трафік {country.upper()}: отримано дані для {fetched} з {len(domains)} доменів")
+    return country_traffic
+
+def save_country_sheets(sheet, sheet_id, current_date, domains, country_traffic):
+    """
+    Сохраняет трафик по странам на листы Traffic_<КОД> (см. save_series_sheets).
+
+    Args:
+        country_traffic (dict): Словарь {страна: {domain: TrafficResult}}
+
+    Returns:
+        dict: Словарь {страна: записанные строки (включая заголовок)}
+    """
+    if not country_traffic:
+        return {}
+    tables = save_series_sheets(sheet, sheet_id, current_date, domains, {
+        country_sheet_title(country): {domain: result.value for domain, result in results.items() if result.is_ok}
+        for country, results in country_traffic.items()
+    })
+    return {country: tables[country_sheet_title(country)] for country in country_traffic}
+
+def comparable_cells(domain, dates, cells):
+    """
+    Отбрасывает значения строки, измеренные до смены режима цели (см. history_start).
+
+    Args:
+        domain (str): Запись из списка доменов
+        dates (list): Даты колонок (от новых к старым)
+        cells (list): Значения строки в тех же колонках
+
+    Returns:
+        tuple: (даты, значения) только сопоставимых колонок
+    """
+    since = history_start(domain)
+    if since is None:
+        return dates, cells
+    pairs = [(date, cell) for date, cell in zip(dates, cells) if date >= since]
+    return [date for date, _ in pairs], [cell for _, cell in pairs]
+
+def build_domains_data(table):
+    """
+    Собирает историю трафика доменов из строк листа для анализа изменений.
+
+    Args:
+        table (list): Строки листа: заголовок ['Domain', даты...] и строки [domain, значения...]
+
+    Returns:
+        dict: Словарь {domain: {'traffic', 'history', 'missing'}}
+    """
+    domains_data = {}
+    for row in table[1:]:  # Пропускаем заголовки
+        if len(row) >= 2:
+            domain = row[0]
+            history = []
+            
+            # Собираем историю трафика (значения до смены режима цели с новыми не сравниваются)
+            for date, cell in zip(*comparable_cells(domain, table[0][1:], row[1:])):
+                try:
+                    history.append({
+                        'date': date,
+                        'traffic': int(cell)
+                    })
+                except (ValueError, TypeError):
+                    continue
+            
+            if history:
+                domains_data[domain] = {
+                    'traffic': history[0]['traffic'],  # Текущий трафик теперь первый в истории
+                    'history': history,
+                    'missing': row[1] == MISSING_TRAFFIC_CELL
+                }
+    return domains_data
+
 def run_test():
     """
     Основная функция, которая выполняет проверку и обновление данных
@@ -419,8 +680,11 @@ def run_test():
     try:
         logger.info("=== Початок функції run_test() ===")
         
-        # Сбрасываем флаг лимита API перед началом работы
-        reset_api_limit_flag()
+        # Лимит API, достигнутый в предыдущем запуске, действует до 24 числа -
+        # в этом случае не отправляем ни одного запроса
+        if should_skip_execution_due_to_limit():
+            logger.warning("⚠️ Ліміт API досягнуто в попередньому запуску. Збір даних пропущено до оновлення лімітів.")
+            return True
         
         # Логуємо системну інформацію
         log_system_info()
@@ -430,8 +694,7 @@ def run_test():
         run_command("ping -c 2 api.ahrefs.com" if platform.system() != "Windows" else "ping -n 2 api.ahrefs.com")
         
         # Проверяем наличие токена
-        api_key = os.getenv('AHREFS_API_KEY')
-        if not api_key:
+        if not AHREFS_API_KEYS:
             logger.error("AHREFS_API_KEY не знайдений в змінних середовища")
             try:
                 if send_message("❌ Помилка: AHREFS_API_KEY не знайдений в змінних середовища", test_mode=True):
@@ -440,7 +703,7 @@ def run_test():
                 logger.error(f"Помилка при відправці повідомлення: {str(e)}")
             return False
         
-        logger.info(f"У функції run_test() AHREFS_API_KEY знайдений, довжина: {len(api_key)}")
+        logger.info(f"У функції run_test() знайдено ключів API Ahrefs: {len(AHREFS_API_KEYS)}")
         
         # Загружаем данные из Google Sheets
         logger.info("Запуск тестового режима")
@@ -450,33 +713,8 @@ def run_test():
         sheet_id = MAIN_SHEET_ID
         logger.info(f"Sheet ID: {sheet_id}")
         
-        # Настройка учетных данных для Google Sheets API
-        try:
-            logger.info("Setting up credentials")
-            creds_json = os.getenv('GOOGLE_SHEETS_CREDENTIALS')
-            if not creds_json:
-                logger.error("GOOGLE_SHEETS_CREDENTIALS not found in environment variables")
-                raise ValueError("GOOGLE_SHEETS_CREDENTIALS not found in environment variables")
-            
-            try:
-                creds_dict = json.loads(creds_json)
-                logger.info("Successfully parsed credentials JSON")
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse credentials JSON: {str(e)}")
-                raise
-            
-            creds = service_account.Credentials.from_service_account_info(
-                creds_dict,
-                scopes=['https://www.googleapis.com/auth/spreadsheets']
-            )
-            logger.info("Credentials setup successfully")
-        except Exception as e:
-            logger.error(f"Error setting up credentials: {str(e)}")
-            raise
-        
         # Создание сервиса Google Sheets
-        service = build('sheets', 'v4', credentials=creds)
-        sheet = service.spreadsheets()
+        sheet = build_sheets_service().spreadsheets()
         
         # Проверяем наличие данных в таблице
         result = sheet.values().get(
@@ -503,6 +741,8 @@ def run_test():
         try:
             with open('domains.txt', 'r', encoding='utf-8') as f:
                 domains = [line.strip() for line in f if line.strip()]
+            # Записи, указывающие на одну и ту же цель Ahrefs, обрабатываем один раз
+            domains = unique_targets(domains)
             logger.info(f"Загружено {len(domains)} доменів з файла")
         except Exception as e:
             logger.error(f"Помилка при читанні файла domains.txt: {str(e)}")
@@ -510,33 +750,31 @@ def run_test():
 
         # Проверяем, есть ли уже данные за сегодня
         headers = values[0] if values else []
-        if len(headers) > 1 and headers[1] == current_date:
+        today_column_exists = len(headers) > 1 and headers[1] == current_date
+        
+        # Определяем, значения каких доменов устарели: свежие значения берем из листа без запросов к API
+        last_fetches = {}
+        for row in values[1:]:
+            if row:
+                last_fetch = find_last_fetch(*comparable_cells(row[0], headers[1:], row[1:]))
+                if last_fetch is not None:
+                    last_fetches[row[0]] = last_fetch
+        freshness = plan_freshness(domains, last_fetches, datetime.now().date(),
+                                   windows=load_freshness_windows())
+        
+        if today_column_exists and freshness.stale:
+            # Столбец за сегодня уже создан (например, частичным запуском), но части значений нет -
+            # дозаполняем его: столбец пересобирается из сохраненных и новых значений
+            logger.info(f"Стовпець за {current_date} вже існує, дозаповнюємо {len(freshness.stale)} відсутніх значень")
+            values = [row[:1] + row[2:] for row in values]
+            headers = values[0]
+            today_column_exists = False
+        
+        if today_column_exists:
             logger.info(f"Дані вже оновлені сьогодні ({current_date}). Перевіряємо зміни трафіку.")
             
             # Анализируем изменения трафика
-            domains_data = {}
-            for row in values[1:]:  # Пропускаем заголовки
-                if len(row) >= 2:
-                    domain = row[0]
-                    history = []
-                    
-                    # Собираем историю трафика
-                    for i in range(1, len(row)):
-                        if i < len(headers):  # Проверяем, что у нас есть соответствующая дата в заголовках
-                            try:
-                                traffic = int(row[i])
-                                history.append({
-                                    'date': headers[i],
-                                    'traffic': traffic
-                                })
-                            except (ValueError, TypeError):
-                                continue
-                    
-                    if history:
-                        domains_data[domain] = {
-                            'traffic': history[-1]['traffic'],
-                            'history': history
-                        }
+            domains_data = build_domains_data(values)
             
             # Анализируем изменения и отправляем уведомление
             has_changes, drops_message, growth_message = analyze_traffic_changes(domains_data)
@@ -577,8 +815,8 @@ def run_test():
                 
             return True
         
-        # Проверяем доступность API перед началом сбора данных
-        if not check_api_availability():
+        # Проверяем доступность API перед началом сбора данных (если есть что запрашивать)
+        if freshness.stale and not check_api_availability():
             logger.error("❌ API Ahrefs недоступно. Збір даних скасовано.")
             logger.error("⚠️ НОВИЙ СТОВПЕЦЬ З ДАТОЮ НЕ БУДЕ СТВОРЕНО через недоступність API.")
             
@@ -600,51 +838,88 @@ def run_test():
         # Подготавливаем новые данные
         new_values = [['Domain', current_date] + headers[1:] if headers else ['Domain', current_date]]
         
-        # ОПТИМИЗАЦИЯ: Получаем трафик для всех доменов через batch запросы
-        logger.info(f"🚀 ОПТИМІЗОВАНИЙ збір даних для {len(domains)} доменів через batch запити")
-        
-        # Разбиваем домены на батчи по 50 доменов
-        batch_size = 50
-        all_traffic_data = {}
-        
-        for i in range(0, len(domains), batch_size):
-            batch_domains = domains[i:i + batch_size]
-            logger.info(f"Обробляємо batch {i//batch_size + 1}: домени {i+1}-{min(i+batch_size, len(domains))}")
+        # Составляем план сбора устаревших доменов в рамках остатка API units: самые важные домены идут первыми
+        timed_out_count = 0
+        if freshness.stale:
+            plan = plan_budget(freshness.stale, get_remaining_api_units(),
+                               weights={domain: last_fetch.value for domain, last_fetch in last_fetches.items()},
+                               priority_domains=load_priority_domains())
             
-            # Получаем трафик для текущего batch'а
-            batch_results = get_batch_organic_traffic(batch_domains)
-            all_traffic_data.update(batch_results)
+            # ОПТИМИЗАЦИЯ: Получаем трафик для устаревших доменов через параллельные batch запросы
+            logger.info(f"🚀 ОПТИМІЗОВАНИЙ збір даних для {len(plan.domains)} доменів через паралельні batch запити")
+            all_traffic_data = fetch_traffic_concurrently(plan.domains)
+            for domain in plan.skipped:
+                all_traffic_data[domain] = TrafficResult.limit_reached()
             
-            logger.info(f"Batch {i//batch_size + 1} завершено: {len(batch_results)} доменів оброблено")
+            # При нехватке времени наименее приоритетные домены пропускаются - записываем то, что успели собрать
+            time_left = fetch_time_left()
+            if time_left is not None and time_left <= 0:
+                timed_out_count = sum(1 for domain in plan.domains
+                                      if not all_traffic_data.get(domain, TrafficResult.missing()).is_ok)
+                logger.warning(f"⏱ Час на збір даних вичерпано: для {timed_out_count} доменів значення не отримано, "
+                               f"зберігаємо зібрані дані")
+        else:
+            logger.info("Всі значення свіжі - запити до API не потрібні")
+            plan = BudgetPlan([], [], 0)
+            all_traffic_data = {}
+        
+        fetched_count = sum(1 for result in all_traffic_data.values() if result.is_ok)
+        
+        # Трафик по странам запрашивается после общего и только для доменов, общий трафик которых получен
+        country_traffic = collect_country_traffic(
+            [domain for domain in plan.domains if all_traffic_data.get(domain, TrafficResult.missing()).is_ok])
+        
+        # Значение, полученное сегодня (дозаполнение столбца), остается в столбце. Более старые свежие
+        # значения не выдаются за сегодняшние: ячейка остается пустой и не участвует в анализе изменений
+        carried_over = set()
+        for domain, value in freshness.fresh.items():
+            if last_fetches[domain].date == datetime.now().date():
+                all_traffic_data[domain] = TrafficResult.ok(value)
+            else:
+                carried_over.add(domain)
+        
+        # Проверяем, не достигнут ли лимит API или бюджет, рассчитанный планировщиком
+        if is_api_limit_reached() or plan.skipped:
+            logger.error("🚫 ЛІМІТ API ДОСЯГНУТО. Збір даних завершено достроково.")
+            logger.error(f"Оброблено {fetched_count} доменів з {len(freshness.stale)} до досягнення ліміту.")
             
-            # Проверяем, не достигнут ли лимит API
-            if is_api_limit_reached():
-                logger.error(f"🚫 ЛІМІТ API ДОСЯГНУТО після batch {i//batch_size + 1}. Припиняємо збір даних.")
-                logger.error(f"Оброблено {len(all_traffic_data)} доменів з {len(domains)} до досягнення ліміту.")
-                logger.error("⚠️ Збір даних припинено через досягнення лімітів токенів API.")
-                logger.error("🔄 Наступний запуск буде можливий після відновлення лімітів API.")
-                logger.error("📊 СТОВПЕЦЬ З НОВОЮ ДАТОЮ НЕ БУДЕ СТВОРЕНО через досягнення лімітів API.")
-                
-                # Отправляем уведомление о достижении лимитов API
+            if fetched_count == 0:
+                logger.error("📊 СТОВПЕЦЬ З НОВОЮ ДАТОЮ НЕ БУДЕ СТВОРЕНО - не отримано жодного значення.")
                 api_error_message = get_api_limit_message()
                 if api_error_message:
-                    api_error_message += f"\n\n📊 Оброблено {len(all_traffic_data)} з {len(domains)} доменів до досягнення ліміту."
                     send_message(api_error_message, parse_mode='Markdown', test_mode=False)
                 else:
-                    send_message(f"🚫 *Увага!*\n\nДосягнуто ліміт API Ahrefs!\n\n📊 Оброблено {len(all_traffic_data)} з {len(domains)} доменів.\n⚠️ Стовпець з новою датою не створено.", 
+                    send_message(f"🚫 *Увага!*\n\nДосягнуто ліміт API Ahrefs!\n\n📊 Оброблено 0 з {len(freshness.stale)} доменів.\n⚠️ Стовпець з новою датою не створено.", 
                                parse_mode='Markdown', test_mode=False)
                 
                 # Возвращаемся без обновления Google Sheets
                 return False
+            
+            # Собранные данные сохраняем, недостающие домены записываются как отсутствующие значения
+            logger.error("📊 Зібрані дані буде збережено, для решти доменів значення позначено як відсутні.")
+            api_error_message = get_api_limit_message() or "🚫 *Увага!*\n\nБюджету API units Ahrefs не вистачає на всі домени!"
+            api_error_message += (f"\n\n📊 Отримано дані для {fetched_count} з {len(freshness.stale)} доменів "
+                                  f"(пріоритетні домени оброблено першими). Для решти доменів значення позначено як відсутні.")
+            send_message(api_error_message, parse_mode='Markdown', test_mode=False)
         
-        logger.info(f"✅ Всього отримано дані для {len(all_traffic_data)} доменів з {len(domains)}")
+        logger.info(f"✅ Всього отримано дані для {fetched_count} доменів з {len(freshness.stale)}, "
+                    f"{len(freshness.fresh)} доменів мають свіже значення в таблиці")
         
         # Обрабатываем каждый домен с полученными данными
         for domain in domains:
-            current_traffic = all_traffic_data.get(domain, 0)
-            logger.info(f"Домен {domain}: трафік = {current_traffic}")
+            result = all_traffic_data.get(domain, TrafficResult.missing())
+            if domain in carried_over:
+                logger.info(f"Домен {domain}: свіже значення від {last_fetches[domain].date}, новий запит не потрібен")
+                traffic_cell = MISSING_TRAFFIC_CELL
+            elif result.is_ok:
+                logger.info(f"Домен {domain}: трафік = {result.value}")
+                traffic_cell = str(result.value)
+            else:
+                # Неудачный запрос не записываем как нулевой трафик, чтобы не испортить историю
+                logger.warning(f"Домен {domain}: значення трафіку відсутнє ({result.status})")
+                traffic_cell = MISSING_TRAFFIC_CELL
             
-            domain_row = [domain, str(current_traffic)]
+            domain_row = [domain, traffic_cell]
             
             # Добавляем исторические данные из Google Sheets (предыдущие значения уже есть!)
             if domain in existing_domains:
@@ -667,42 +942,40 @@ def run_test():
         
         logger.info(f"Дані успішно збережені в Google Sheets: {result.get('updatedCells')} ячеек оновлено")
         
-        # Анализируем изменения трафика
-        domains_data = {}
-        for row in new_values[1:]:  # Пропускаем заголовки
-            if len(row) >= 2:
-                domain = row[0]
-                history = []
-                
-                # Собираем историю трафика
-                for i in range(1, len(row)):
-                    if i < len(new_values[0]):  # Проверяем, что у нас есть соответствующая дата в заголовках
-                        try:
-                            traffic = int(row[i])
-                            history.append({
-                                'date': new_values[0][i],
-                                'traffic': traffic
-                            })
-                        except (ValueError, TypeError):
-                            continue
-                
-                if history:
-                    domains_data[domain] = {
-                        'traffic': history[0]['traffic'],  # Текущий трафик теперь первый в истории
-                        'history': history
-                    }
+        # Дополнительные метрики получены теми же batch запросами - сохраняем их на свои листы.
+        # Ошибка записи этих листов не должна мешать анализу трафика и уведомлению
+        try:
+            save_metric_sheets(sheet, sheet_id, current_date, domains, all_traffic_data)
+        except Exception as e:
+            logger.error(f"Помилка при збереженні додаткових метрик: {str(e)}")
+        
+        # Трафик по странам хранится на своих листах рядом с общим (ошибка записи не мешает уведомлению)
+        try:
+            country_tables = save_country_sheets(sheet, sheet_id, current_date, domains, country_traffic)
+        except Exception as e:
+            logger.error(f"Помилка при збереженні трафіку за країнами: {str(e)}")
+            country_tables = {}
         
         # Анализируем изменения трафика
+        domains_data = build_domains_data(new_values)
         has_changes, drops_message, growth_message = analyze_traffic_changes(domains_data)
         
+        # Падения по каждому рынку анализируются так же, как общий трафик
+        market_messages = []
+        for country, table in country_tables.items():
+            logger.info(f"Аналізуємо зміни трафіку для ринку {country.upper()}")
+            market_changes, market_drops, _ = analyze_traffic_changes(build_domains_data(table))
+            if market_changes:
+                market_messages.append(f"🌍 Ринок {country.upper()}:\n{market_drops}")
+        
         # Если сообщение None (данные устарели), не отправляем ничего
-        if drops_message is None and growth_message is None:
+        if drops_message is None and growth_message is None and not market_messages:
             logger.info("Повідомлення не відправляється через застарілість даних.")
             return True
         
         # Проверяем, есть ли реальные изменения (падения или рост)
         # Если есть только сообщение "Критичних змін трафіку не виявлено" и нет роста, не отправляем
-        if (not has_changes and 
+        if (not has_changes and not market_messages and
             drops_message and "Критичних змін трафіку не виявлено" in drops_message and 
             not growth_message):
             logger.info("Повідомлення не відправляється - немає критичних змін трафіку та росту доменів.")
@@ -710,6 +983,8 @@ def run_test():
         
         # Додаємо до drops_message і growth_message інформацію про кількість оновлених доменів
         message = f"✅ Дані про трафік успішно оновлено для {len(domains)} доменів\n\n"
+        if timed_out_count:
+            message += f"⏱ Час запуску вичерпано: для {timed_out_count} найменш пріоритетних доменів значення не отримано\n\n"
         
         # Если есть сообщение о падениях, добавляем его к сообщению
         if drops_message:
@@ -717,7 +992,12 @@ def run_test():
         
         # Если есть сообщение о росте, добавляем его к сообщению
         if growth_message:
-            message += growth_message
+            message += growth_message + "\n\n"
+        
+        # Падения по отдельным рынкам
+        for market_message in market_messages:
+            message += market_message + "\n\n"
+        message = message.rstrip("\n")
         
         # Отправляем результаты анализа в Telegram (test_mode=False означає відправка у всі чати, включаючи робочі)
         telegram_result = send_message(message, parse_mode="HTML", test_mode=False)
@@ -741,6 +1021,104 @@ def run_test():
             
         return False
 
+def run_backfill():
+    """
+    Дозаполняет пропущенные недели (например, после заморозки из-за лимита API):
+    для каждого домена одним запросом metrics-history получает недельную историю
+    и вставляет колонки для всех пропущенных дат в порядке дат
+    """
+    try:
+        logger.info("=== Початок дозаповнення пропущених тижнів ===")
+        
+        if should_skip_execution_due_to_limit():
+            logger.warning("⚠️ Ліміт API досягнуто в попередньому запуску. Дозаповнення пропущено.")
+            return True
+        
+        from config import MAIN_SHEET_ID
+        sheet_id = MAIN_SHEET_ID
+        sheet = build_sheets_service().spreadsheets()
+        
+        values = sheet.values().get(
+            spreadsheetId=sheet_id,
+            range='Traffic!A1:ZZ'
+        ).execute().get('values', [])
+        if len(values) < 2:
+            logger.info("Таблиця порожня - дозаповнювати нічого")
+            return True
+        
+        headers = values[0]
+        missing_dates = find_missing_weeks(headers[1:])
+        if not missing_dates:
+            logger.info("Пропущених тижнів немає")
+            return True
+        logger.info(f"Пропущені тижні: {', '.join(missing_dates)}")
+        
+        rows = {row[0]: row[1:] for row in values[1:] if row}
+        last_fetches = {}
+        for domain, cells in rows.items():
+            last_fetch = find_last_fetch(headers[1:], cells)
+            if last_fetch is not None:
+                last_fetches[domain] = last_fetch
+        
+        # Один запрос истории на домен за весь период (с неделей до первой пропущенной даты)
+        date_from = (datetime.strptime(missing_dates[-1], '%Y-%m-%d') - timedelta(days=BACKFILL_INTERVAL_DAYS)).strftime('%Y-%m-%d')
+        date_to = missing_dates[0]
+        plan = plan_budget(list(rows), get_remaining_api_units(),
+                           weights={domain: last_fetch.value for domain, last_fetch in last_fetches.items()},
+                           priority_domains=load_priority_domains(), cost=estimate_history_units)
+        histories = fetch_history_concurrently(plan.domains, date_from, date_to)
+        
+        # Вставляем пропущенные даты, сохраняя порядок колонок от новых к старым
+        all_dates = sorted(set(headers[1:]) | set(missing_dates), reverse=True)
+        new_values = [['Domain'] + all_dates]
+        filled_count = 0
+        for domain, cells in rows.items():
+            cells_by_date = dict(zip(headers[1:], cells))
+            history = histories.get(domain)
+            domain_row = [domain]
+            for date in all_dates:
+                if date not in missing_dates:
+                    domain_row.append(cells_by_date.get(date, MISSING_TRAFFIC_CELL))
+                    continue
+                value = pick_history_value(history, date) if history is not None else None
+                if value is None:
+                    domain_row.append(MISSING_TRAFFIC_CELL)
+                else:
+                    domain_row.append(str(value))
+                    filled_count += 1
+            new_values.append(domain_row)
+        
+        if filled_count == 0:
+            logger.error("Не отримано жодного значення історії - таблицю не змінено")
+            return False
+        
+        sheet.values().clear(
+            spreadsheetId=sheet_id,
+            range='Traffic!A1:ZZ'
+        ).execute()
+        sheet.values().update(
+            spreadsheetId=sheet_id,
+            range='Traffic!A1',
+            valueInputOption='RAW',
+            body={'values': new_values}
+        ).execute()
+        
+        message = (f"✅ Дозаповнено {len(missing_dates)} пропущених тижнів: {filled_count} значень "
+                   f"для {len(histories)} з {len(rows)} доменів")
+        if is_api_limit_reached() or plan.skipped:
+            message += "\n⚠️ Бюджету API units не вистачило на всі домени - для решти значення позначено як відсутні"
+        logger.info(message)
+        send_message(message, test_mode=True)
+        return True
+    
+    except Exception as e:
+        logger.error(f"Помилка при дозаповненні пропущених тижнів: {str(e)}")
+        error_details = traceback.format_exc()
+        logger.error(error_details)
+        send_message(f"❌ Помилка дозаповнення: {str(e)}\n\n```\n{error_details[:1900]}```",
+                     parse_mode="Markdown", test_mode=True)
+        return False
+
 def log_system_info():
     """Логування інформації про систему"""
     logger.info(f"Python версія: {sys.version}")
@@ -780,7 +1158,8 @@ def run_command(command):
         return None
 
 if __name__ == "__main__":
-    success = run_test()
+    # --backfill: дозаполнить пропущенные недели вместо обычного сбора
+    success = run_backfill() if "--backfill" in sys.argv else run_test()
     if not success:
         logger.error("Тест завершився з помилкою")
         exit(1) 
\ No newline at end of file